@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+#
+# Version: 2026.10.18
+# Author: Serhiy Kobyakov
+
+
+import json
+import os
+import struct
+import numpy as np
+import cv2
+from image_metadata import file_stamp
+
+# cv2.KeyPoint fields packed into a flat array,
+# so the keypoints can be stored and shared between processes without pickling objects
+KEYPOINT_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('size', '<f4'), ('angle', '<f4'),
+                           ('response', '<f4'), ('octave', '<i4'), ('class_id', '<i4')])
+
+STORE_MAGIC = b'PPSFEAT1'
+# keypoints and descriptors blocks start at multiple of this
+BLOCK_ALIGN = 64
+
+
+def keypoints_to_array(keypoints):
+    """pack cv2.KeyPoint objects into KEYPOINT_DTYPE array"""
+    return np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave, k.class_id) for k in keypoints],
+                    dtype=KEYPOINT_DTYPE)
+
+
+def array_to_keypoints(kp_arr):
+    """unpack KEYPOINT_DTYPE array into the list of cv2.KeyPoint objects"""
+    return [cv2.KeyPoint(x=float(k['x']), y=float(k['y']), size=float(k['size']), angle=float(k['angle']),
+                         response=float(k['response']), octave=int(k['octave']), class_id=int(k['class_id']))
+            for k in kp_arr]
+
+
+def data_offset(index_len):
+    """offset of the first data block in the store file"""
+    header_len = len(STORE_MAGIC) + 8 + index_len
+    return header_len + (-header_len % BLOCK_ALIGN)
+
+
+class FeatureStore:
+    """Keypoints and descriptors of all images of the stack in a single binary file
+
+    File layout:
+        8 bytes   - STORE_MAGIC
+        8 bytes   - little endian length of the JSON index
+        JSON index: {image file name: {stamp, params, count, kp_offset, dscr_offset, dscr_shape, dscr_dtype}}
+        data blocks (keypoints as KEYPOINT_DTYPE array, descriptors as raw array) aligned to BLOCK_ALIGN,
+        the offsets in the index are relative to the first data block
+
+    The file is memory-mapped, so get() returns read-only views on the file without copying.
+    Entry is valid as long as the image file size, mtime and detection parameters are the same."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.index = {}
+        self.data = None
+        self.data_start = 0
+        self.new_entries = {}
+        if os.path.isfile(fname):
+            try:
+                self.index, self.data, self.data_start = self.read(fname)
+            except (ValueError, OSError):
+                print(f"\n***Warning: can't read feature store {fname}, the features will be computed again")
+                self.index, self.data, self.data_start = {}, None, 0
+
+    @staticmethod
+    def read(fname):
+        with open(fname, 'rb') as f:
+            if f.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                raise ValueError(f"{fname} is not a feature store")
+            index_len, = struct.unpack('<Q', f.read(8))
+            index = json.loads(f.read(index_len).decode('utf-8'))
+        return index, np.memmap(fname, dtype=np.uint8, mode='r'), data_offset(index_len)
+
+    def get(self, img_fname, params):
+        """return (keypoints, descriptors) of the image if the stored ones are up to date, None otherwise"""
+        if img_fname in self.new_entries:
+            return self.new_entries[img_fname][2:]
+        entry = self.index.get(img_fname)
+        if entry is None or entry['params'] != params or \
+                not os.path.isfile(img_fname) or entry['stamp'] != file_stamp(img_fname):
+            return None
+        return self.entry_arrays(entry)
+
+    def entry_arrays(self, entry):
+        kp_start = self.data_start + entry['kp_offset']
+        kp_end = kp_start + entry['count'] * KEYPOINT_DTYPE.itemsize
+        keypoints = self.data[kp_start:kp_end].view(KEYPOINT_DTYPE)
+        dscr_dtype = np.dtype(entry['dscr_dtype'])
+        dscr_start = self.data_start + entry['dscr_offset']
+        dscr_end = dscr_start + int(np.prod(entry['dscr_shape'])) * dscr_dtype.itemsize
+        descriptors = self.data[dscr_start:dscr_end].view(dscr_dtype).reshape(entry['dscr_shape'])
+        return keypoints, descriptors
+
+    def put(self, img_fname, params, keypoints, descriptors):
+        """add (or replace) features of the image, the store file is updated by save()"""
+        if descriptors is None:
+            descriptors = np.zeros((0, 0), dtype=np.uint8)
+        self.new_entries[img_fname] = (file_stamp(img_fname), params,
+                                       np.ascontiguousarray(keypoints, dtype=KEYPOINT_DTYPE),
+                                       np.ascontiguousarray(descriptors))
+
+    def save(self):
+        """rewrite the store with the new entries; entries of missing images are dropped"""
+        if len(self.new_entries) == 0:
+            return
+        blocks = []
+        index = {}
+        offset = 0
+
+        def add_block(arr):
+            nonlocal offset
+            offset += -offset % BLOCK_ALIGN
+            blocks.append((offset, arr))
+            start = offset
+            offset += arr.nbytes
+            return start
+
+        for img_fname in sorted(set(self.index) | set(self.new_entries)):
+            if not os.path.isfile(img_fname):
+                continue
+            if img_fname in self.new_entries:
+                stamp, params, keypoints, descriptors = self.new_entries[img_fname]
+            else:
+                stamp, params = self.index[img_fname]['stamp'], self.index[img_fname]['params']
+                keypoints, descriptors = self.entry_arrays(self.index[img_fname])
+            index[img_fname] = {'stamp': stamp,
+                                'params': params,
+                                'count': len(keypoints),
+                                'kp_offset': add_block(keypoints),
+                                'dscr_offset': add_block(descriptors),
+                                'dscr_shape': list(descriptors.shape),
+                                'dscr_dtype': descriptors.dtype.str}
+
+        index_bytes = json.dumps(index).encode('utf-8')
+        data_start = data_offset(len(index_bytes))
+
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'wb') as f:
+            f.write(STORE_MAGIC)
+            f.write(struct.pack('<Q', len(index_bytes)))
+            f.write(index_bytes)
+            for block_offset, arr in blocks:
+                f.seek(data_start + block_offset)
+                f.write(np.ascontiguousarray(arr).data)
+        os.replace(tmp_fname, self.fname)
+
+        self.index, self.data, self.data_start = self.read(self.fname)
+        self.new_entries = {}
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+#
+# Version: 2026.10.18
+# Author: Serhiy Kobyakov
+
+
+import json
+import os
+import struct
+import cv2
+import numpy as np
+
+# uncompressed intermediate frame files: FRAME_MAGIC, 8 bytes little endian length of JSON header,
+# JSON header and raw C-order pixels starting at multiple of FRAME_ALIGN, so the frame
+# is memory-mapped and the row band or the tile of it reads only the pages it covers
+FRAME_EXT = '.ppf'
+FRAME_MAGIC = b'PPSFRAM1'
+FRAME_ALIGN = 4096
+
+# TIFF ExtraSamples tag and its value for the unassociated alpha channel
+TIFF_EXTRA_SAMPLES = 338
+TIFF_UNASSOCIATED_ALPHA = 2
+
+
+def is_frame_file(fname):
+    return fname.lower().endswith(FRAME_EXT)
+
+
+def frame_data_offset(header_len):
+    header_len += len(FRAME_MAGIC) + 8
+    return header_len + (-header_len % FRAME_ALIGN)
+
+
+def geometry_tags(shape, dtype):
+    """image tags describing the pixels of the frame (as exiftool reports them for tiffs)"""
+    return {'FileType': 'PPF',
+            'ImageWidth': shape[1],
+            'ImageHeight': shape[0],
+            'SamplesPerPixel': shape[2] if len(shape) > 2 else 1,
+            'BitsPerSample': np.dtype(dtype).itemsize * 8}
+
+
+def create_frame(fname, shape, dtype, tags=None, transform=None):
+    """create frame file of given shape and type, return it memory-mapped for writing
+
+    tags:      image tags of the source image (see image_metadata.STACK_TAGS),
+               the tags describing the pixels are replaced by the actual ones
+    transform: 3x3 matrix which maps the pixels of the source image to the pixels of the frame
+
+    The file is written as <fname>.tmp and gets its name in finish_frame()."""
+    header = {'shape': list(shape), 'dtype': np.dtype(dtype).str,
+              'tags': dict(tags or {}, **geometry_tags(shape, dtype)),
+              'transform': None if transform is None else np.asarray(transform, dtype=np.float64).tolist()}
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = frame_data_offset(len(header_bytes))
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(FRAME_MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+    return np.memmap(tmp_fname, dtype=np.dtype(dtype), mode='r+', offset=data_start, shape=tuple(shape))
+
+
+def finish_frame(frame, fname):
+    """flush the frame made by create_frame() and give it its name"""
+    frame.flush()
+    tmp_fname = frame.filename
+    del frame
+    os.replace(tmp_fname, fname)
+
+
+def write_frame(fname, img, tags=None, transform=None):
+    frame = create_frame(fname, img.shape, img.dtype, tags, transform)
+    frame[...] = img
+    finish_frame(frame, fname)
+
+
+def read_frame_header(fname):
+    """{'shape', 'dtype', 'tags', 'transform'} of the frame file, plus the offset of the pixels"""
+    with open(fname, 'rb') as f:
+        if f.read(len(FRAME_MAGIC)) != FRAME_MAGIC:
+            raise ValueError(f"{fname} is not a frame file")
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    header['offset'] = frame_data_offset(header_len)
+    return header
+
+
+def open_frame(fname):
+    """frame file memory-mapped read-only (nothing is read until the pixels are accessed)"""
+    header = read_frame_header(fname)
+    return np.memmap(fname, dtype=np.dtype(header['dtype']), mode='r', offset=header['offset'],
+                     shape=tuple(header['shape']))
+
+
+def frame_to_bgr8(img):
+    """8-bit BGR copy of the frame, as cv2.imread(..., IMREAD_COLOR) reads 16-bit tiffs"""
+    if img.dtype == np.uint16:
+        # rounded the way libtiff does it
+        img = ((img.astype(np.uint32) * 255 + 32767) // 65535).astype(np.uint8)
+    else:
+        img = np.asarray(img, dtype=np.uint8)
+    if img.ndim == 2 or img.shape[2] == 1:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return np.ascontiguousarray(img)
+
+
+def imread(fname, flags=cv2.IMREAD_UNCHANGED):
+    """cv2.imread() which reads frame files too: IMREAD_UNCHANGED gives the memory-mapped frame,
+    IMREAD_COLOR and IMREAD_GRAYSCALE give 8-bit copy of it"""
+    if not is_frame_file(fname):
+        return cv2.imread(fname, flags)
+    frame = open_frame(fname)
+    if flags == cv2.IMREAD_UNCHANGED:
+        return frame
+    if flags == cv2.IMREAD_COLOR:
+        return frame_to_bgr8(frame)
+    if flags == cv2.IMREAD_GRAYSCALE:
+        return cv2.cvtColor(frame_to_bgr8(frame), cv2.COLOR_BGR2GRAY)
+    raise ValueError(f"unsupported imread flags for the frame file {fname}: {flags}")
+
+
+def tiff_mark_alpha(fname):
+    """mark the 4th channel of the tiff written by cv2.imwrite() as alpha: OpenCV doesn't write
+    ExtraSamples tag, so libtiff warns on every read and the other programs may take it for a color channel
+
+    The first image directory with the tag added is appended to the end of the file
+    (BigTIFF is not changed). Return True if the tag is there."""
+    with open(fname, 'r+b') as f:
+        bo = '<' if f.read(2) == b'II' else '>'
+        magic, ifd_offset = struct.unpack(bo + 'HI', f.read(6))
+        if magic != 42:
+            return False
+        f.seek(ifd_offset)
+        n, = struct.unpack(bo + 'H', f.read(2))
+        entries = [f.read(12) for _ in range(n)]
+        next_ifd = f.read(4)
+        if TIFF_EXTRA_SAMPLES in [struct.unpack(bo + 'H', x[:2])[0] for x in entries]:
+            return True
+        # SHORT value is kept in the first bytes of the entry value field
+        entries.append(struct.pack(bo + 'HHIH', TIFF_EXTRA_SAMPLES, 3, 1, TIFF_UNASSOCIATED_ALPHA) + b'\0\0')
+        entries.sort(key=lambda x: struct.unpack(bo + 'H', x[:2])[0])
+        f.seek(0, os.SEEK_END)
+        # the directory starts on a word boundary
+        new_offset = f.tell() + f.tell() % 2
+        f.write(b'\0' * (new_offset - f.tell()))
+        f.write(struct.pack(bo + 'H', len(entries)) + b''.join(entries) + next_ifd)
+        f.seek(4)
+        f.write(struct.pack(bo + 'I', new_offset))
+    return True
+
+
+def imwrite(fname, img, tags=None, transform=None):
+    """cv2.imwrite() which writes frame files too (tags and transform are kept in frame files only),
+    the alpha channel of 4-channel tiffs is marked by ExtraSamples tag"""
+    if is_frame_file(fname):
+        write_frame(fname, img, tags, transform)
+        return True
+    if not cv2.imwrite(fname, img):
+        return False
+    if fname.lower().endswith(('.tif', '.tiff')) and img.ndim == 3 and img.shape[2] == 4:
+        tiff_mark_alpha(fname)
+    return True
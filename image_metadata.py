@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+#
+# Version: 2026.10.18
+# Author: Serhiy Kobyakov
+
+
+import atexit
+import json
+import os
+import subprocess
+from frame_file import is_frame_file, read_frame_header
+
+# image tags cached for every image of the stack
+STACK_TAGS = ['FileType', 'ImageWidth', 'ImageHeight', 'SamplesPerPixel', 'BitsPerSample',
+              'ExposureTime', 'ISO', 'Make', 'Model', 'LensModel', 'FocalLength']
+
+METADATA_CACHE_FNAME = 'stack_metadata.json'
+
+
+def file_stamp(fname):
+    """size and modification time of the file, used to find out if the file has been changed"""
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class ExifTool:
+    """exiftool process started once with -stay_open and fed with commands through stdin,
+    so every request costs a pipe round trip instead of a new process"""
+
+    READY = b'{ready}\n'
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.proc = subprocess.Popen(['exiftool', '-stay_open', 'True', '-@', '-'],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def execute(self, *args):
+        """run exiftool with given arguments, return its output"""
+        # one argument per line is what -@ expects
+        self.proc.stdin.write(('\n'.join(args) + '\n-execute\n').encode('utf-8'))
+        self.proc.stdin.flush()
+        output = b''
+        fd = self.proc.stdout.fileno()
+        while not output.endswith(self.READY):
+            chunk = os.read(fd, 65536)
+            if len(chunk) == 0:
+                raise OSError("exiftool process has been terminated")
+            output += chunk
+        return output[:-len(self.READY)].decode('utf-8')
+
+    def close(self):
+        if self.proc.poll() is None and self.pid == os.getpid():
+            self.proc.stdin.write(b'-stay_open\nFalse\n')
+            self.proc.stdin.flush()
+            self.proc.wait()
+
+
+exiftool_proc = None
+
+
+def exiftool():
+    """exiftool process of the current process (started on the first call)"""
+    global exiftool_proc
+    # worker processes forked from the parent must not share its exiftool pipes
+    if exiftool_proc is None or exiftool_proc.pid != os.getpid():
+        exiftool_proc = ExifTool()
+        atexit.register(exiftool_proc.close)
+    return exiftool_proc
+
+
+def read_tags(fnames, tags):
+    """read tags of all given files by single exiftool request, return {file name: {tag: value}}"""
+    if len(fnames) == 0:
+        return {}
+    output = exiftool().execute('-j', '-n', *['-' + tag for tag in tags], *fnames)
+    res = {}
+    for item in json.loads(output) if output.strip() else []:
+        fname = item.pop('SourceFile')
+        res[fname] = item
+    return res
+
+
+def copy_tags(src_fname, dst_fname, orientation=False):
+    """copy all tags from src to dst image, orientation is copied only if the pixels of dst
+    are not rotated the way it says (orientation=True)"""
+    exclude = [] if orientation else ['--Orientation']
+    exiftool().execute('-TagsFromFile', src_fname, '-all:all>all:all', *exclude, '-overwrite_original',
+                       dst_fname)
+
+
+class StackMetadata:
+    """STACK_TAGS of all images of the stack
+
+    Tags are read for all images not known yet by single exiftool request (frame files keep them
+    in the header, see frame_file.py) and cached in METADATA_CACHE_FNAME, the cache entry is valid
+    while the image size and mtime are the same."""
+
+    def __init__(self, cache_fname=METADATA_CACHE_FNAME):
+        self.cache_fname = cache_fname
+        self.cache = {}
+        if os.path.isfile(cache_fname):
+            try:
+                with open(cache_fname, 'r') as f:
+                    self.cache = json.load(f)
+            except (ValueError, OSError):
+                self.cache = {}
+
+    def is_fresh(self, fname):
+        entry = self.cache.get(fname)
+        return entry is not None and os.path.isfile(fname) and entry['stamp'] == file_stamp(fname)
+
+    def prefetch(self, fnames):
+        """read tags of all the images which are not in the cache yet"""
+        missing = [x for x in dict.fromkeys(fnames) if os.path.isfile(x) and not self.is_fresh(x)]
+        if len(missing) == 0:
+            return
+        # frame files keep their tags in the header, exiftool does not know them
+        tags = read_tags([x for x in missing if not is_frame_file(x)], STACK_TAGS)
+        tags.update({x: read_frame_header(x)['tags'] for x in missing if is_frame_file(x)})
+        for fname in missing:
+            self.cache[fname] = {'stamp': file_stamp(fname), 'tags': tags.get(fname, {})}
+        self.save()
+
+    def save(self):
+        # written as a whole into the temporary file first (the worker processes may save it too)
+        tmp_fname = f"{self.cache_fname}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_fname, 'w') as f:
+                json.dump(self.cache, f, indent=1)
+            os.replace(tmp_fname, self.cache_fname)
+        except OSError:
+            pass
+
+    def get(self, fname, tag, default=None):
+        """value of the image tag"""
+        if not self.is_fresh(fname):
+            self.prefetch([fname])
+        return self.cache.get(fname, {}).get('tags', {}).get(tag, default)
+
+    def tags(self, fname):
+        """all cached tags of the image"""
+        if not self.is_fresh(fname):
+            self.prefetch([fname])
+        return dict(self.cache.get(fname, {}).get('tags', {}))
+
+    def image_size(self, fname):
+        """image width and height"""
+        return int(self.get(fname, 'ImageWidth')), int(self.get(fname, 'ImageHeight'))
+
+
+stack_metadata_obj = None
+
+
+def stack_metadata(fnames=()):
+    """StackMetadata of the current directory shared by all the calls in the process,
+    tags of the given images are prefetched"""
+    global stack_metadata_obj
+    if stack_metadata_obj is None:
+        stack_metadata_obj = StackMetadata()
+    stack_metadata_obj.prefetch(fnames)
+    return stack_metadata_obj
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+#
+# Version: 2026.10.18
+# Author: Serhiy Kobyakov
+
+
+import os
+import threading
+import multiprocessing as mp
+
+# part of available memory used by default when memory budget is not given
+DEFAULT_MEM_FRACTION = 0.8
+
+GB = 1024 ** 3
+
+
+def available_cores():
+    """number of cores this process is allowed to run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return mp.cpu_count()
+
+
+def available_memory():
+    """MemAvailable from /proc/meminfo in bytes (None if it can't be read)"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def parse_size(size_str):
+    """convert memory size like '32G', '512M' or '24' (gigabytes) into bytes"""
+    size_str = size_str.strip().upper()
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': GB, 'T': 1024 ** 4}
+    if size_str[-1:] in units:
+        return int(float(size_str[:-1]) * units[size_str[-1]])
+    return int(float(size_str) * GB)
+
+
+def default_mem_budget():
+    mem = available_memory()
+    if mem is None:
+        mem = 4 * GB
+    return int(mem * DEFAULT_MEM_FRACTION)
+
+
+class JobScheduler:
+    """Run jobs in a process pool admitting the next job only while the memory
+    estimated for all running jobs fits the memory budget.
+
+    The pool size is limited by the number of available cores and by the number
+    of the smallest jobs which fit the budget at once. A job which does not fit
+    the budget alone is run when nothing else is running."""
+
+    def __init__(self, mem_budget, nproc=None, initializer=None, initargs=()):
+        self.mem_budget = mem_budget
+        self.nproc = nproc if nproc is not None else available_cores()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.cond = threading.Condition()
+        self.mem_reserved = 0
+        self.running = 0
+        self.errors = []
+
+    def pool_size(self, estimates):
+        if len(estimates) == 0:
+            return 1
+        fit = max(1, int(self.mem_budget // max(1, min(estimates))))
+        return max(1, min(self.nproc, fit, len(estimates)))
+
+    def run(self, func, jobs, estimates, on_result=None):
+        """call func(*job) for every job, return the list of results in the order of jobs
+
+        jobs      - list of argument tuples
+        estimates - peak memory (bytes) of each job
+        on_result - optional callback on_result(job_index, result) called in the parent process
+                    as soon as the job is done"""
+        results = [None] * len(jobs)
+        nproc = self.pool_size(estimates)
+        pool = mp.Pool(processes=nproc, initializer=self.initializer, initargs=self.initargs)
+
+        def done(i, mem, res):
+            results[i] = res
+            if on_result is not None:
+                try:
+                    on_result(i, res)
+                except Exception as e:
+                    self.errors.append(e)
+            release(mem)
+
+        def failed(mem, err):
+            self.errors.append(err)
+            release(mem)
+
+        def release(mem):
+            with self.cond:
+                self.mem_reserved -= mem
+                self.running -= 1
+                self.cond.notify_all()
+
+        try:
+            for i, (job, mem) in enumerate(zip(jobs, estimates)):
+                with self.cond:
+                    while self.running > 0 and \
+                            (self.running >= nproc or self.mem_reserved + mem > self.mem_budget):
+                        self.cond.wait()
+                    if len(self.errors) > 0:
+                        break
+                    self.mem_reserved += mem
+                    self.running += 1
+                pool.apply_async(func, job,
+                                 callback=lambda res, i=i, mem=mem: done(i, mem, res),
+                                 error_callback=lambda err, mem=mem: failed(mem, err))
+            with self.cond:
+                while self.running > 0:
+                    self.cond.wait()
+        finally:
+            pool.close()
+            pool.join()
+
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        return results
+
+
+class TaskGraph:
+    """Run the tasks of a graph (DAG) in a thread pool as soon as the tasks they depend on are done,
+    admitting the next task only while the memory estimated for all running tasks fits the memory budget.
+
+    The tasks are started in the order they have been added, so the task added earlier is preferred
+    over the later ones which are ready too. OpenCV and numpy release GIL, so the threads run in parallel."""
+
+    def __init__(self, mem_budget, nthreads=None):
+        self.mem_budget = mem_budget
+        self.nthreads = nthreads if nthreads is not None else available_cores()
+        self.tasks = {}
+
+    def add(self, name, func, deps=(), mem=0):
+        """add task func(*results of deps) estimated to use mem bytes, deps must be added already"""
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError(f"task {name} depends on unknown task {dep}")
+        self.tasks[name] = (func, tuple(deps), mem)
+        return name
+
+    def run(self):
+        """run all the tasks, return {task name: result}"""
+        results = {}
+        pending = list(self.tasks)
+        cond = threading.Condition()
+        state = {'mem': 0, 'running': 0}
+        errors = []
+
+        def call(name, func, deps, mem):
+            try:
+                res = func(*[results[dep] for dep in deps])
+                with cond:
+                    results[name] = res
+            except BaseException as e:
+                with cond:
+                    errors.append(e)
+            finally:
+                with cond:
+                    state['mem'] -= mem
+                    state['running'] -= 1
+                    cond.notify_all()
+
+        def next_task():
+            for name in pending:
+                func, deps, mem = self.tasks[name]
+                if all(dep in results for dep in deps) and \
+                        (state['running'] == 0 or state['mem'] + mem <= self.mem_budget):
+                    return name
+            return None
+
+        with cond:
+            while len(pending) > 0 and len(errors) == 0:
+                name = next_task() if state['running'] < self.nthreads else None
+                if name is None:
+                    if state['running'] == 0:
+                        raise ValueError(f"tasks can't be run: {pending}")
+                    cond.wait()
+                    continue
+                pending.remove(name)
+                func, deps, mem = self.tasks[name]
+                state['mem'] += mem
+                state['running'] += 1
+                threading.Thread(target=call, args=(name, func, deps, mem), daemon=True).start()
+            while state['running'] > 0:
+                cond.wait()
+
+        if len(errors) > 0:
+            raise errors[0]
+        return results
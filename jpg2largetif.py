@@ -6,21 +6,45 @@
 
 import os
 import sys
-import subprocess
-# import multiprocessing as mp
+import cv2
+import frame_file
+from image_metadata import stack_metadata, copy_tags
+from job_scheduler import JobScheduler, default_mem_budget, parse_size, GB
+from run_report import report
+from stack_align import promote_to_16bit, scale_matrix, UPSCALE_INTERPOLATION
+from tca_corr import stack_tca, tca_required, correct_tca, tca_memory, TCA_SAMPLE_SIZE
+
+# the images are upscaled this many times
+UPSCALE = 2
+
+# memory used per pixel of the jpg: decoded image, 16-bit BGRA image, upscaled one and the tiff encoder buffer
+CONVERT_BYTES_PER_PIXEL = 3 + 8 + 2 * 8 * UPSCALE ** 2
 
 
 def print_usage():
     usage_str = """The script converts jpg images to 16-bit tiffs
 preserving metadata information.
 
-Usage: jpg2largetif [images list]
+Usage: jpg2largetif [options] [images list]
 
 Example: jpg2largetif.py *.jpg
 
+Options:
+    -mem=<size>:  memory budget, e.g. 24G or 512M (gigabytes if no unit given);
+                  default is 80% of the available memory.
+                  Images are converted in parallel as long as they fit the budget.
+    -ppf:     save uncompressed memory-mapped frame files (.ppf, see frame_file.py)
+              instead of tiffs: they are written and read by stack_align.py and stack_avg.py
+              much faster (and by tca_corr.py -native), but the other programs can't read them
+    -tca[=<n>]:   correct transverse chromatic aberration while upscaling (red and blue channels
+                  are corrected and upscaled by single remap), TCA is estimated by tca_correct on n images
+                  (default {TCA_SAMPLE_SIZE}) or taken from the cache, see tca_corr.py -sample
+    -report:  save wall time, CPU time and peak memory of every processing stage
+              into jpg2largetif_report.json and jpg2largetif_report.csv
+
 Warning: for now the scripts works onl
 """
-    print(usage_str)
+    print(usage_str.format(TCA_SAMPLE_SIZE=TCA_SAMPLE_SIZE))
     sys.exit(1)
 
 
@@ -28,38 +52,70 @@ def file_is_jpeg(filename) -> bool:
     '''Check if the argument is existing jpg file'''
     output = ''
     if os.path.exists(filename):
-        cmd = "exiftool -FileType -s -s -s " + filename
-        output = subprocess.check_output(cmd, shell=True).decode('ascii').strip()
+        output = stack_metadata().get(filename, 'FileType', '')
 
     if output == 'JPEG':
         return True
     else:
         return False
 
-def convert_to_ltif(jpg_file):
-    '''Convert jpg to tif'''
-    tif_file = '{0}.tif'.format(jpg_file[:-4])
+def convert_to_ltif(jpg_file, ext='.tif', tca_line=None):
+    '''Convert jpg to tif: rotate according to EXIF orientation, upscale 2x,
+    convert to 16-bit with alpha channel and copy metadata (as
+    convert -auto-orient -resize 200% -depth 16 -alpha On + exiftool did),
+    return stages records of the process
+
+    ext='.ppf' writes frame file keeping the tags and the upscale transform in its header,
+    tca_line - TCA correction ('-r a:b:c:d -b a:b:c:d' line of fulla) made in the same pass as upscale'''
+    tif_file = jpg_file[:-4] + ext
     if not os.path.isfile(tif_file):
-        command = 'convert {0} -auto-orient -resize 200% -depth 16 -alpha On {1} >/dev/null 2>&1'.format(jpg_file, tif_file)
-        os.system(command)
+        with report.stage('decode', jpg_file):
+            # EXIF orientation is applied by imread
+            img = cv2.imread(jpg_file, cv2.IMREAD_COLOR)
+        with report.stage('convert', jpg_file):
+            # upscale 16-bit image, so the interpolated values are not rounded to 8 bits
+            img = promote_to_16bit(img)
+            img_up = cv2.resize(img, None, fx=UPSCALE, fy=UPSCALE, interpolation=UPSCALE_INTERPOLATION)
+        if tca_line is not None:
+            with report.stage('tca', jpg_file):
+                # red and blue channels are upscaled once more with TCA correction
+                correct_tca(img, tca_line, UPSCALE, img_up)
+        img = img_up
+        del img_up
+        with report.stage('encode', jpg_file):
+            frame_file.imwrite(tif_file, img, stack_metadata().tags(jpg_file), scale_matrix(UPSCALE))
+        del img
         print('.', end='', flush=True)
-        command = "exiftool -TagsFromFile {0} -all:all\>all:all --Orientation -overwrite_original {1} >/dev/null 2>&1".format(jpg_file, tif_file)
-        os.system(command)
+        if not frame_file.is_frame_file(tif_file):
+            with report.stage('metadata', jpg_file):
+                copy_tags(jpg_file, tif_file)
     print('.', end='', flush=True)
+    return report.pop_records()
 
 
 if __name__ == "__main__":
-    # if mp.cpu_count() > 2:
-    #     nproc = round(mp.cpu_count() * 3 / 4)
-    # else:
-    #     nproc = 2
-    # print('  threads in use:', nproc, 'of', mp.cpu_count())
-
     jpg_files = []
+    save_report = False
+    mem_budget = default_mem_budget()
+    ext = '.tif'
+    tca_sample = None
+
+    # read file types of all the arguments at once
+    stack_metadata([x for x in sys.argv[1:] if os.path.isfile(x)])
 
     for arg in sys.argv[1:]:
         if arg == "--help":
             print_usage()
+        elif arg == "-report":
+            save_report = True
+        elif arg.startswith("-mem="):
+            mem_budget = parse_size(arg[5:])
+        elif arg == "-tca":
+            tca_sample = TCA_SAMPLE_SIZE
+        elif arg.startswith("-tca="):
+            tca_sample = int(arg[5:])
+        elif arg == "-ppf":
+            ext = frame_file.FRAME_EXT
         elif file_is_jpeg(arg):
             # append image file to images list
             jpg_files.append(arg)
@@ -70,11 +126,29 @@ if __name__ == "__main__":
     if len(jpg_files) > 0:
         print(f"Converting {len(jpg_files)} images..", end='')
 
-        for jpg_file in jpg_files:
-            convert_to_ltif(jpg_file)
+        meta = stack_metadata()
+        tca_lines = {}
+        if tca_sample is not None:
+            # TCA is corrected only if it is visible on the upscaled image
+            tca_lines = {x: tca_line for x, tca_line in stack_tca(jpg_files, tca_sample).items()
+                         if tca_required(tca_line, *[UPSCALE * v for v in meta.image_size(x)])}
+            print(f"TCA of {len(tca_lines)} images will be corrected..", end='')
+        # TCA correction (-tca) takes 16-bit red and blue channels of the image and the remap grids of one band
+        estimates = [meta.image_size(x)[0] * meta.image_size(x)[1] * CONVERT_BYTES_PER_PIXEL +
+                     (tca_memory(UPSCALE * meta.image_size(x)[0], 2 * meta.image_size(x)[0] * meta.image_size(x)[1])
+                      if x in tca_lines else 0) for x in jpg_files]
+        # worker processes drop the stages inherited from the parent
+        scheduler = JobScheduler(mem_budget, initializer=report.pop_records)
+        print(f"({scheduler.pool_size(estimates)} processes, {round(max(estimates) / GB, 1)} Gb per image)",
+              end='', flush=True)
+        for records in scheduler.run(convert_to_ltif, [(x, ext, tca_lines.get(x)) for x in jpg_files], estimates):
+            report.extend(records)
 
         print('done')
 
+    if save_report:
+        report.save('jpg2largetif')
+
     # # start monitoring memory usage
     # # cmd = "cat /proc/meminfo | grep 'MemAvailable' > stack_align_mem.log; while true; do cat /proc/meminfo | grep 'MemFree' >> stack_align_mem.log; echo; sleep 1; done"
     # cmd = "cat /proc/meminfo | grep 'MemAvailable' > jpg2largetif_mem.log; while true; do cat /proc/meminfo | grep 'MemFree' >> jpg2largetif_mem.log; sleep 1; done"
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+#
+# Version: 2026.10.18
+# Author: Serhiy Kobyakov
+
+
+import csv
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+MB = 1024 ** 2
+
+
+def reset_peak_rss():
+    """reset peak resident memory of the process (linux only, silently ignored elsewhere)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """peak resident memory of the process (bytes) since the last reset_peak_rss()"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # kilobytes on linux, lifetime peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cpu_time():
+    """CPU time used by the process and its finished children (external tools)"""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class RunReport:
+    """Wall time, CPU time and peak RSS of the processing stages of every frame
+
+    Every process records its own stages; worker processes return pop_records()
+    to the parent which adds them by extend().
+    Peak RSS is measured for the process as a whole, so only the stages of the main thread get it;
+    the stages of the other threads (background decoding, pipeline tasks) overlap them and get
+    wall time and CPU time of their thread only."""
+
+    def __init__(self):
+        self.records = []
+        self.start_wall = time.time()
+        self.start_cpu = cpu_time()
+
+    @contextmanager
+    def stage(self, stage, frame=''):
+        """record the stage of processing the frame:
+            with report.stage('decode', fname):
+                ...
+        stages must not be nested, peak RSS is reset at the start of every stage of the main thread"""
+        main = threading.current_thread() is threading.main_thread()
+        thread_cpu_time = cpu_time if main else time.thread_time
+        if main:
+            reset_peak_rss()
+        wall, cpu = time.perf_counter(), thread_cpu_time()
+        try:
+            yield
+        finally:
+            self.records.append({'stage': stage,
+                                 'frame': frame,
+                                 'pid': os.getpid(),
+                                 'wall': time.perf_counter() - wall,
+                                 'cpu': thread_cpu_time() - cpu,
+                                 'peak_rss': peak_rss() if main else None})
+
+    def pop_records(self):
+        """records of this process collected since the previous call"""
+        records, self.records = self.records, []
+        return records
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def summary(self):
+        """per stage totals in the order of the first appearance of the stage"""
+        stages = {}
+        for rec in self.records:
+            st = stages.setdefault(rec['stage'], {'stage': rec['stage'], 'count': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                  'peak_rss': None})
+            st['count'] += 1
+            st['wall'] += rec['wall']
+            st['cpu'] += rec['cpu']
+            if rec['peak_rss'] is not None:
+                st['peak_rss'] = max(st['peak_rss'] or 0, rec['peak_rss'])
+        return list(stages.values())
+
+    def save(self, script_name):
+        """save <script_name>_report.json (summary and all records) and <script_name>_report.csv
+        (all records), print summary table"""
+        summary = self.summary()
+        total = {'wall': time.time() - self.start_wall,
+                 'cpu': cpu_time() - self.start_cpu,
+                 'peak_rss': max([rec['peak_rss'] for rec in self.records if rec['peak_rss'] is not None] +
+                                 [peak_rss()])}
+        with open(script_name + '_report.json', 'w') as f:
+            json.dump({'script': script_name,
+                       'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_wall)),
+                       'total': total,
+                       'stages': summary,
+                       'records': self.records}, f, indent=1)
+        with open(script_name + '_report.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['stage', 'frame', 'pid', 'wall', 'cpu', 'peak_rss'])
+            writer.writeheader()
+            writer.writerows(self.records)
+
+        print(f"\n{'stage':<12}{'count':>7}{'wall, s':>11}{'per frame':>11}{'cpu, s':>11}{'peak RSS, Mb':>14}")
+        for st in summary:
+            peak = '-' if st['peak_rss'] is None else f"{st['peak_rss'] / MB:.0f}"
+            print(f"{st['stage']:<12}{st['count']:>7}{st['wall']:>11.2f}{st['wall'] / st['count']:>11.3f}"
+                  f"{st['cpu']:>11.2f}{peak:>14}")
+        print(f"{'total':<12}{'':>7}{total['wall']:>11.2f}{'':>11}{total['cpu']:>11.2f}{total['peak_rss'] / MB:>14.0f}")
+
+
+# stages of the current process
+report = RunReport()
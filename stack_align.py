@@ -5,319 +5,977 @@
 
 
 from __future__ import print_function
+import math
 import os
-import subprocess
 import sys
 import glob
-from itertools import repeat
-import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 import cv2
 import numpy as np
-from math import sqrt
+import frame_file
+from feature_store import FeatureStore, keypoints_to_array
+from image_metadata import stack_metadata
+from job_scheduler import JobScheduler, default_mem_budget, parse_size, GB
+from run_report import report
+from stack_avg import SharedAccumulator, averaged_image_fname, finish_averaged_image, load_partial, frame_coverage
+from stack_manifest import StackManifest
+from tca_corr import parse_tca_line, tca_source_coords, tca_max_shift
  
 MAX_FEATURES = 10000
 GOOD_MATCH_PERCENT = 0.25
 
-def save_keypoints(keypoints, imgfname_query):
-    """save keypoints to file"""
-    with open(imgfname_query + '.keypoints', "w") as f:
-        for point in keypoints:
-            p = str(point.pt[0]) + "," + str(point.pt[1]) + "," + str(point.size) + "," + str(point.angle) + "," +\
-                str(point.response) + "," + str(point.octave) + "," + str(point.class_id) + "\n"
-            f.write(p)
-
-
-def load_keypoints(imgfname_query):
-    """load keypoints from file"""
-    keypoints = []
-    lines = [line.strip() for line in open(imgfname_query + '.keypoints', "r")]
-    for line in lines:
-        lst = line.split(',')
-        if len(lst) == 7:
-            kp = cv2.KeyPoint(x=float(lst[0]), y=float(lst[1]), size=float(lst[2]), angle=float(lst[3]),
-                              response=float(lst[4]), octave=int(lst[5]), class_id=int(lst[6]))
-            keypoints.append(kp)
-    return keypoints
-
-
-def save_descriptors(descriptors, imgfname_query):
-    """save descriptors to file"""
-    np.save(imgfname_query + '.descriptors', descriptors)
-
+# stack features are kept in this file between the runs
+FEATURES_FNAME = 'stack_align_features.dat'
+
+# running sum of the aligned images kept by -avg mode between the runs
+ACC_FNAME = 'stack_align_sum.part'
+
+# reference (train) image data shared by the parent process, see init_align_worker()
+train = {}
+
+# subpixel refinement of homography using ECC (enhanced correlation coefficient):
+# size of the central region of the image, max number of iterations and convergence threshold
+ECC_ROI_SIZE = 2048
+ECC_ITERATIONS = 100
+ECC_EPS = 1e-6
+
+# FLANN LSH index over the train descriptors (-matcher=lsh): number of hash tables,
+# hash key size (bits), number of neighbouring buckets probed and max number of candidates checked
+FLANN_INDEX_LSH = 6
+LSH_TABLES = 12
+LSH_KEY_SIZE = 20
+LSH_PROBE_LEVEL = 1
+LSH_CHECKS = 64
+
+# windowed matching (-window): the query keypoints are moved by the prior homography before they
+# are matched within the window, the prior is estimated on the images reduced to this size (longer side)
+WINDOW_PRIOR_SIZE = 1024
+
+# memory allocated by AKAZE per pixel of the image being processed
+# (nonlinear scale space of float images), estimated from the memory usage
+# of 16 Mp jpegs upscaled to 64 Mp tiffs: ~60 Gb with 8 processes
+AKAZE_BYTES_PER_PIXEL = 90
+
+# interpolation used to warp the original jpgs straight onto the upscaled grid (-upscale mode)
+UPSCALE_INTERPOLATION = cv2.INTER_CUBIC
+
+# aligned images are warped by square tiles of this size using several threads,
+# source region of every tile is extended by the margin for the interpolation kernel
+WARP_TILE_SIZE = 1024
+WARP_TILE_MARGIN = 4
+WARP_THREADS = 4
+# source region, warped tile, its coverage and float64 copies added to the accumulator
+WARP_TILE_BYTES_PER_PIXEL = 64
+# TCA corrected in the same remap as the tile is warped: float32 source coordinates of the tile pixels,
+# remap grids of the red or blue channel, their temporaries and the remapped channel
+WARP_TCA_BYTES_PER_PIXEL = 2 * 4 + 2 * 4 + 4 * 4 + 8
+
+
+def print_usage():
+    usage_str = """The script aligns images to the first one (sorted by file name)
+and saves the aligned images as al_<image file name>.tif
+
+Usage: stack_align.py [options] [images list]
+
+Example: stack_align.py -mem=24G *.tif
+
+Images aligned by the previous runs to the same reference image with the same
+options are skipped (see stack_align_manifest.json), so the interrupted run may be
+continued and new images may be added to the stack.
+
+Options:
+    -mem=<size>:          memory budget, e.g. 24G or 512M (gigabytes if no unit given);
+                          default is 80% of the available memory.
+                          Images are aligned in parallel as long as they fit the budget.
+    -detect-scale=<n>:    detect and match keypoints on images reduced n times
+                          (use 2 to work on the original resolution of 2x upscaled tiffs)
+                          homography is scaled back to the full size images
+    -ecc:                 refine homography at full resolution using ECC
+                          on the central region of the images (subpixel accuracy)
+    -avg:                 average the aligned images on the fly into <first jpg name>_averaged.tif
+                          (the result is moved to the parent directory as stack_avg.py does),
+                          aligned images are not saved
+    -save-aligned:        save aligned images in -avg mode too
+    -matcher=<bf|lsh>:    bf - exact brute force matching of keypoints descriptors (default),
+                          lsh - approximate nearest neighbours search in FLANN LSH index
+                          built once over the train descriptors (much faster for many keypoints)
+    -window=<pixels>:     match every query keypoint only to the train keypoints within
+                          the window of given size around its position mapped by the rough homography
+                          estimated on the images reduced to {WINDOW_PRIOR_SIZE} pixels, overrides -matcher
+    -ppf:                 save aligned images as uncompressed memory-mapped frame files
+                          al_<image file name>.ppf (see frame_file.py), the aligned image is not
+                          held in memory and stack_avg.py reads it much faster than tiff
+    -upscale=<n>:         align the original jpgs and warp every one of them straight onto
+                          n times upscaled grid (16-bit with alpha channel, as jpg2largetif.py
+                          makes them), so the large tiffs are not needed at all
+    -report:              save wall time, CPU time and peak memory of every processing stage
+                          into stack_align_report.json and stack_align_report.csv
+"""
+    print(usage_str.format(WINDOW_PRIOR_SIZE=WINDOW_PRIOR_SIZE))
+    sys.exit(1)
+
+
+def mask_stamp():
+    """mask.png modification time, keypoints of all images depend on it"""
+    if os.path.isfile('mask.png'):
+        return os.stat('mask.png').st_mtime_ns
+    return None
+
+
+def image_geometry(fnames):
+    """width, height, number of channels and bytes per channel of the images
+    (read from the image headers)"""
+    meta = stack_metadata(fnames)
+    geometry = []
+    for fname in fnames:
+        width, height = meta.image_size(fname)
+        channels = int(meta.get(fname, 'SamplesPerPixel', 3))
+        bits = int(str(meta.get(fname, 'BitsPerSample', 8)).split()[0])
+        geometry.append((width, height, channels, (bits + 7) // 8))
+    return geometry
+
+
+def align_memory_estimate(width, height, channels, depth, detect_scale=1, upscale=1, save_aligned=True):
+    """peak memory (bytes) used by alignImages2 for the query image of given size"""
+    npix = width * height
+    detect_npix = npix / detect_scale ** 2
+    if upscale == 1:
+        # full depth query image and the warped one (if it is saved)
+        out_bytes = channels * depth * (1 + save_aligned)
+    else:
+        # 8-bit query jpg and 16-bit BGRA warped image on the upscaled grid (if it is saved)
+        out_bytes = 3 + 8 * upscale ** 2 * save_aligned
+    return int(npix * (3 +                     # query image, 8-bit BGR
+                       2 +                     # gray and blurred gray images
+                       2 * 3 +                 # debug image with matches (query and train side by side)
+                       out_bytes) +
+               detect_npix * (AKAZE_BYTES_PER_PIXEL +  # keypoints detection on reduced image
+                              1 + 3) +                 # reduced image and debug image with keypoints
+               WARP_THREADS * WARP_TILE_SIZE ** 2 * WARP_TILE_BYTES_PER_PIXEL)
+
+
+def blur_kernel_size(fname_train):
+    """size of the blur kernel used before the keypoints detection
+    estimated from the exposure time of the train image"""
+    expo = float(stack_metadata().get(fname_train, 'ExposureTime'))
+    kern_size = round(87.5 * expo - 1.6)
+    if kern_size % 2 == 0:
+        kern_size += 1
+    return kern_size
+
+
+def scale_matrix(scale):
+    """homography which maps pixel coordinates of the image reduced (scale) times
+    to the pixel coordinates of the full size image (pixel centers are preserved)"""
+    return np.array([[scale, 0, (scale - 1) / 2],
+                     [0, scale, (scale - 1) / 2],
+                     [0, 0, 1]], dtype=np.float64)
+
+
+def promote_to_16bit(img):
+    """8-bit BGR image -> 16-bit BGRA image with opaque alpha channel"""
+    return cv2.cvtColor(img, cv2.COLOR_BGR2BGRA).astype(np.uint16) * 257
+
+
+def warp_frame(img, h, size, upscale=1, out=None, acc=None, tca_line=None):
+    """warp the image by homography h onto the grid of the train image of given size (width, height)
+    upscaled (upscale) times, 8-bit BGR image is promoted to 16-bit BGRA if upscale > 1;
+    if the radial TCA of the image is given ('-r a:b:c:d -b a:b:c:d' line of fulla), the red and blue
+    channels are corrected by the same remap as they are warped (see warp_tile_tca())
+
+    The output is made tile by tile, every tile is warped from the region of the source image it needs
+    and written into out array and/or added to the accumulator acc (SharedAccumulator),
+    tiles are warped by WARP_THREADS threads. The result is within 1 level of the full frame
+    cv2.warpPerspective(): its fixed-point coordinates are rounded relative to the tile origin. Return out."""
+    if upscale != 1:
+        h = scale_matrix(upscale) @ h
+    width, height = size[0] * upscale, size[1] * upscale
+    h_inv = np.linalg.inv(h)
+    interpolation = cv2.INTER_LINEAR if upscale == 1 else UPSCALE_INTERPOLATION
+    # coverage of the frames without alpha channel
+    with_alpha = upscale != 1 or (img.ndim == 3 and img.shape[2] == 4)
+    margin = WARP_TILE_MARGIN
+    tca = None
+    if tca_line is not None and img.ndim == 3 and img.shape[2] >= 3:
+        tca = parse_tca_line(tca_line)
+        # the red and blue channels of the tile are taken from the source region shifted by TCA
+        margin += math.ceil(tca_max_shift(tca_line, *img.shape[:2]))
+
+    def warp_tile(x0, y0):
+        x1, y1 = min(x0 + WARP_TILE_SIZE, width), min(y0 + WARP_TILE_SIZE, height)
+        # source region which is mapped onto the tile (the homography maps the tile to quadrangle)
+        corners = np.array([[[x0, y0]], [[x1 - 1, y0]], [[x0, y1 - 1]], [[x1 - 1, y1 - 1]]], dtype=np.float64)
+        src_corners = cv2.perspectiveTransform(corners, h_inv).reshape(-1, 2)
+        sx0, sy0 = np.floor(src_corners.min(axis=0)).astype(int) - margin
+        sx1, sy1 = np.ceil(src_corners.max(axis=0)).astype(int) + margin + 1
+        sx0, sy0 = max(sx0, 0), max(sy0, 0)
+        sx1, sy1 = min(sx1, img.shape[1]), min(sy1, img.shape[0])
+        if sx0 >= sx1 or sy0 >= sy1:
+            # the tile is not covered by the frame
+            return
+        src = img[sy0:sy1, sx0:sx1]
+        if upscale != 1 and src.dtype == np.uint8:
+            src = promote_to_16bit(src)
+        h_tile = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64) @ h @ \
+            np.array([[1, 0, sx0], [0, 1, sy0], [0, 0, 1]], dtype=np.float64)
+        tile = cv2.warpPerspective(src, h_tile, (x1 - x0, y1 - y0), flags=interpolation)
+        if tca is not None:
+            warp_tile_tca(tile, src, h_tile, (sx0, sy0), img.shape[:2], tca, interpolation)
+        if out is not None:
+            out[y0:y1, x0:x1] = tile
+        if acc is not None:
+            coverage = None
+            if not with_alpha:
+                coverage = cv2.warpPerspective(np.ones(src.shape[:2], dtype=np.float32), h_tile, (x1 - x0, y1 - y0))
+            acc.add(tile, coverage, (y0, x0))
+
+    tiles = [(x0, y0) for y0 in range(0, height, WARP_TILE_SIZE) for x0 in range(0, width, WARP_TILE_SIZE)]
+    with ThreadPoolExecutor(max_workers=WARP_THREADS) as executor:
+        # list() re-raises exceptions of the threads
+        list(executor.map(lambda tile: warp_tile(*tile), tiles))
+    return out
+
+
+def warp_tile_tca(tile, src, h_tile, origin, img_shape, tca, interpolation):
+    """replace the red and blue channels of the tile warped from src by homography h_tile with the ones
+    corrected for radial TCA and warped by single remap
+
+    origin - (x, y) position of src in the image of img_shape (height, width),
+    tca - {'r': [a, b, c, d], 'b': [a, b, c, d]} coefficients of the image (see tca_corr.tca_source_coords())"""
+    h_inv = np.linalg.inv(h_tile)
+    y, x = np.mgrid[0:tile.shape[0], 0:tile.shape[1]].astype(np.float32)
+    # source image coordinates of the tile pixels
+    xy = cv2.perspectiveTransform(np.dstack((x, y)), h_inv)
+    del x, y
+    sx, sy = xy[..., 0] + np.float32(origin[0]), xy[..., 1] + np.float32(origin[1])
+    del xy
+    # the channels are faded out where the warped frame ends, as warpPerspective() does it with the others
+    coverage = frame_coverage(tile)
+    for ch, idx in (('r', 2), ('b', 0)):
+        map_x, map_y = tca_source_coords(sx, sy, img_shape[0], img_shape[1], tca[ch])
+        channel = cv2.remap(np.ascontiguousarray(src[..., idx]), map_x - np.float32(origin[0]),
+                            map_y - np.float32(origin[1]),
+                            interpolation, borderMode=cv2.BORDER_REPLICATE)
+        tile[..., idx] = channel * coverage + 0.5
+
+
+def warped_frame_shape(img, size, upscale=1):
+    """shape and type of the image made by warp_frame()"""
+    if upscale != 1:
+        return (size[1] * upscale, size[0] * upscale, 4), np.uint16
+    return (size[1], size[0]) + img.shape[2:], img.dtype
+
+
+def warped_frame_array(img, size, upscale=1):
+    """empty output array for warp_frame()"""
+    return np.zeros(*warped_frame_shape(img, size, upscale))
+
+
+def aligned_fname(fname, ext='.tif'):
+    """name of the aligned image file, ext is '.tif' or frame_file.FRAME_EXT"""
+    return 'al_' + fname + ext
+
+
+def load_mask():
+    """mask.png as the mask for keypoints detection: 255 where keypoints may be detected,
+    0 in the regions painted red (None if there is no mask.png)"""
+    if not os.path.isfile('mask.png'):
+        return None
+    img_map = cv2.imread('mask.png', cv2.IMREAD_COLOR)
+    return np.where(img_map[:, :, 2] == 0, 255, 0).astype(np.uint8)
+
+
+def detect_features(im_gray, detect_scale=1, mask=None, debug_image=True):
+    """detect AKAZE features on the image reduced detect_scale times
+    outside the masked regions (mask covers the whole image, any size),
+    keypoints are returned in the coordinates of the full size image
+
+    return keypoints array, descriptors and the debug image with keypoints drawn (None if not debug_image)"""
+    if detect_scale != 1:
+        im_gray = cv2.resize(im_gray, None, fx=1 / detect_scale, fy=1 / detect_scale, interpolation=cv2.INTER_AREA)
+    if mask is not None:
+        mask = cv2.resize(mask, im_gray.shape[1::-1], interpolation=cv2.INTER_NEAREST)
+    detector = cv2.AKAZE_create()
+    kp, dscr = detector.detectAndCompute(im_gray, mask)
 
-def load_descriptors(imgfname_query):
-    """load descriptors from file"""
-    return np.load(imgfname_query + '.descriptors.npy')
+    # save image with all points
+    # for debug purposes
+    impoints = None
+    if debug_image:
+        impoints = cv2.drawKeypoints(im_gray, kp, 0, (0, 0, 255), flags=cv2.DRAW_MATCHES_FLAGS_NOT_DRAW_SINGLE_POINTS)
+
+    kp_arr = keypoints_to_array(kp)
+    if detect_scale != 1:
+        kp_arr['x'] = kp_arr['x'] * detect_scale + (detect_scale - 1) / 2
+        kp_arr['y'] = kp_arr['y'] * detect_scale + (detect_scale - 1) / 2
+        kp_arr['size'] *= detect_scale
+    return kp_arr, dscr, impoints
+
+
+def refine_homography_ecc(im_train, im_queryGray, h, roi_size=ECC_ROI_SIZE):
+    """refine homography h (query -> train) at full resolution
+    maximizing enhanced correlation coefficient (ECC) in the central region of the train image"""
+    height, width = im_train.shape[:2]
+    roi_w, roi_h = min(roi_size, width), min(roi_size, height)
+    x0, y0 = (width - roi_w) // 2, (height - roi_h) // 2
+    template = cv2.cvtColor(im_train[y0:y0 + roi_h, x0:x0 + roi_w], cv2.COLOR_BGR2GRAY)
+
+    # ECC warp maps the template (train roi) coordinates to the input (query) coordinates
+    roi_offset = np.array([[1, 0, x0], [0, 1, y0], [0, 0, 1]], dtype=np.float64)
+    warp = np.linalg.inv(h) @ roi_offset
+    warp = (warp / warp[2, 2]).astype(np.float32)
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, ECC_ITERATIONS, ECC_EPS)
+    cc, warp = cv2.findTransformECC(template, im_queryGray, warp, cv2.MOTION_HOMOGRAPHY, criteria, None, 5)
+
+    h_ecc = np.linalg.inv(warp.astype(np.float64) @ np.linalg.inv(roi_offset))
+    return h_ecc / h_ecc[2, 2], cc
+
+
+def train_features(fname_train, store, detect_scale=1, im_train=None, debug_images=True):
+    """read train image (unless it is given decoded), detect its AKAZE features outside the regions
+    masked by mask.png (or take the features from the store if they are up to date),
+    the debug image with keypoints is saved if debug_images"""
+    if im_train is None:
+        with report.stage('decode', fname_train):
+            im_train = frame_file.imread(fname_train, cv2.IMREAD_COLOR)
+
+    kern_size = blur_kernel_size(fname_train)
+    params = {'kern_size': kern_size, 'mask': mask_stamp(), 'detect_scale': detect_scale}
+    cached = store.get(fname_train, params)
+    if cached is not None:
+        kp_arr, dscr_train = cached
+    else:
+        with report.stage('blur', fname_train):
+            im_trainGray = cv2.cvtColor(im_train, cv2.COLOR_BGR2GRAY)
+
+            # prepare gray image for processing
+            #
+            # check the difference between gaussian blur and adaptive noise reduction
+            if kern_size >= 3:
+                im_trainGray = cv2.blur(im_trainGray, (7, 7))
+
+        with report.stage('detect', fname_train):
+            kp_arr, dscr_train, impoints = detect_features(im_trainGray, detect_scale, load_mask(), debug_images)
+        if debug_images:
+            cv2.imwrite(fname_train + "_keypoints.jpg", impoints)
+
+        store.put(fname_train, params, kp_arr, dscr_train)
+
+    return {'fname': fname_train,
+            'kern_size': kern_size,
+            'detect_scale': detect_scale,
+            'image': im_train,
+            'keypoints': kp_arr,
+            'descriptors': dscr_train}
+
+
+def share_train_features(ref, ecc=False, acc=None, save_aligned=True, upscale=1, matcher='bf', window=None,
+                         aligned_ext='.tif', debug_images=True):
+    """copy the train image data into shared memory blocks
+
+    Return the list of blocks (the caller must unlink them when the work is done)
+    and the picklable description which init_align_worker() uses to attach the blocks."""
+    blocks = []
+    ref_info = {'fname': ref['fname'], 'kern_size': ref['kern_size'], 'detect_scale': ref['detect_scale'],
+                'ecc': ecc, 'store': FEATURES_FNAME, 'arrays': {},
+                'acc': None if acc is None else acc.info, 'save_aligned': save_aligned, 'upscale': upscale,
+                'matcher': matcher, 'window': window, 'aligned_ext': aligned_ext, 'debug_images': debug_images}
+    for key in ('image', 'keypoints', 'descriptors'):
+        arr = ref[key]
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        blocks.append(shm)
+        ref_info['arrays'][key] = (shm.name, arr.shape, arr.dtype)
+    return blocks, ref_info
+
+
+def use_train_features(ref, store, ecc=False, save_aligned=True, upscale=1, matcher='bf', window=None,
+                       aligned_ext='.tif', debug_images=True):
+    """align the images of this process to the train image made by train_features(),
+    the debug images with keypoints and matches are saved if debug_images"""
+    train.update(ref)
+    train['store'] = store
+    train['ecc'] = ecc
+    train['save_aligned'] = save_aligned
+    train['upscale'] = upscale
+    train['matcher'] = matcher
+    train['window'] = window
+    train['aligned_ext'] = aligned_ext
+    train['debug_images'] = debug_images
+    train['mask'] = load_mask()
+    train['kp_xy'] = keypoints_xy(train['keypoints'])
+
+
+def init_align_worker(ref_info):
+    """attach train image data published by the parent process (read-only)"""
+    # drop the stages of the parent process inherited by fork
+    report.pop_records()
+    train['fname'] = ref_info['fname']
+    train['kern_size'] = ref_info['kern_size']
+    train['detect_scale'] = ref_info['detect_scale']
+    train['ecc'] = ref_info['ecc']
+    train['save_aligned'] = ref_info['save_aligned']
+    train['upscale'] = ref_info['upscale']
+    train['matcher'] = ref_info['matcher']
+    train['window'] = ref_info['window']
+    train['aligned_ext'] = ref_info['aligned_ext']
+    train['debug_images'] = ref_info['debug_images']
+    train['mask'] = load_mask()
+    if ref_info['acc'] is not None:
+        train['acc'] = SharedAccumulator(None, ref_info['acc'])
+    train['store'] = FeatureStore(ref_info['store'])
+    train['blocks'] = []
+    for key, (name, shape, dtype) in ref_info['arrays'].items():
+        shm = shared_memory.SharedMemory(name=name)
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        arr.flags.writeable = False
+        train['blocks'].append(shm)
+        train[key] = arr
+    train['kp_xy'] = keypoints_xy(train['keypoints'])
 
 
 def alignImages2(*imgfiles):
-    """warp image fname_query so it is aligned to fname_train"""
+    """warp image fname_query so it is aligned to fname_train
+    (the homography found by the previous run may be given as the third argument)"""
 
     # train image - reference
     # query image - the one which must be transformed
     fname_train, fname_query = imgfiles[0], imgfiles[1]
+    h_known = imgfiles[2] if len(imgfiles) > 2 else None
     logstr = f"Train img: {fname_train}\nQuery img: {fname_query}\n\n"
 
-    # read images
-    im_query = cv2.imread(fname_query, cv2.IMREAD_COLOR)
-    im_train = cv2.imread(fname_train, cv2.IMREAD_COLOR)
+    if train.get('fname') != fname_train:
+        # not in the worker process initialized by init_align_worker()
+        store = FeatureStore(FEATURES_FNAME)
+        use_train_features(train_features(fname_train, store), store)
 
-    # Convert images to grayscale
-    im_queryGray = cv2.cvtColor(im_query, cv2.COLOR_BGR2GRAY)
-    im_trainGray = cv2.cvtColor(im_train, cv2.COLOR_BGR2GRAY)
-    print('.', end='', flush=True)
+    if h_known is None:
+        found = query_homography(fname_query)
+        h2 = found['homography']
+        logstr += found['log']
+    else:
+        found = {'features': None, 'stats': None}
+        h2 = np.array(h_known, dtype=np.float64)
+        logstr += "homography found by the previous run is used\n"
 
-    # prepare gray image for processing
-    #
-    # check the difference between gaussian blur and adaptive noise reduction
-    # print(f"fname_train: {fname_train} ")
-    logstr += "Train img exposure time: " + \
-              subprocess.check_output(f"exiftool -ExposureTime -s -s -s {fname_train}", shell=True).decode('ascii') +\
-              "\n"
-    expo = float(subprocess.check_output(f"exiftool -ExposureTime -n -s -s -s {fname_train}", shell=True))
-    # print(f"fname_train: {fname_train}   expo: {expo}")
-    kern_size = round(87.5 * expo - 1.6)
-    if kern_size % 2 == 0:
-        kern_size += 1
+    # Use homography to warp the image
+    height, width = train['image'].shape[:2]
 
-    if kern_size >= 3:
-        # print(f"kernel size:", kern_size)
-        im_queryGray = cv2.blur(im_queryGray, (7, 7))
+    # export the transformed image
+    # im_queryReg = cv2.warpPerspective(im_query, h2, (width, height))
+    upscale = train['upscale']
+    with report.stage('decode', fname_query):
+        if upscale == 1:
+            # frame file is memory-mapped, the tiles read only the regions they need
+            im_queryFull = frame_file.imread(fname_query, cv2.IMREAD_UNCHANGED)
+        else:
+            # the original jpg goes straight to the upscaled grid,
+            # the homography maps jpg to jpg pixels
+            im_queryFull = frame_file.imread(fname_query, cv2.IMREAD_COLOR)
+    # the warped image is made in memory only if it is saved as tiff, the tiles go straight
+    # into the memory-mapped frame file and/or into the accumulator otherwise
+    im_queryReg = None
+    al_fname = aligned_fname(fname_query, train['aligned_ext'])
+    if train['save_aligned'] and frame_file.is_frame_file(al_fname):
+        im_queryReg = frame_file.create_frame(al_fname, *warped_frame_shape(im_queryFull, (width, height), upscale),
+                                              stack_metadata().tags(fname_query), scale_matrix(upscale) @ h2)
+    elif train['save_aligned']:
+        im_queryReg = warped_frame_array(im_queryFull, (width, height), upscale)
+    with report.stage('warp', fname_query):
+        warp_frame(im_queryFull, h2, (width, height), upscale, im_queryReg, train.get('acc'))
+    del im_queryFull
+    if train['save_aligned']:
+        with report.stage('encode', fname_query):
+            if frame_file.is_frame_file(al_fname):
+                frame_file.finish_frame(im_queryReg, al_fname)
+            else:
+                cv2.imwrite(al_fname, im_queryReg)
+    im_queryReg = None
 
     print('.', end='', flush=True)
+    with open(fname_query + "_log.txt", "w") as f:
+        f.write(logstr)
 
-    # Detect AKAZE features and compute descriptors.
-    detector = cv2.AKAZE_create()
-    kp_query, dscr_query = detector.detectAndCompute(im_queryGray, None)
-    save_keypoints(kp_query, fname_query)
-    save_descriptors(dscr_query, fname_query)
-    logstr += f"found {len(kp_query)} keypoints in query img\n"
+    return {'fname': fname_query,
+            'features': found['features'],
+            'homography': h2.tolist(),
+            'stats': found['stats'],
+            'report': report.pop_records()}
+
+
+def query_homography(fname_query, im_query=None):
+    """find homography which maps the query image (read unless it is given decoded as 8-bit BGR)
+    to the train one"""
+    im_train = train['image']
+    kp_train_xy, dscr_train = train['kp_xy'], train['descriptors']
+    kern_size = train['kern_size']
+    detect_scale = train['detect_scale']
+    logstr = f"{len(kp_train_xy)} keypoints of train img are shared by the parent process\n"
+
+    # read image
+    with report.stage('decode', fname_query):
+        if im_query is None:
+            im_query = frame_file.imread(fname_query, cv2.IMREAD_COLOR)
+        # Convert image to grayscale
+        im_queryGray = cv2.cvtColor(im_query, cv2.COLOR_BGR2GRAY)
+    print('.', end='', flush=True)
 
-    # save image with all points
-    # for debug purposes
-    impoints = cv2.drawKeypoints(im_queryGray, kp_query, 0, (0, 0, 255),
-                                 flags=cv2.DRAW_MATCHES_FLAGS_NOT_DRAW_SINGLE_POINTS)
-    cv2.imwrite(fname_query + "_keypoints.jpg", impoints)
-
-    if os.path.isfile(fname_train + '.keypoints') and os.path.isfile(fname_train + '.descriptors.npy'):
-        kp_train = load_keypoints(fname_train)
-        dscr_train = load_descriptors(fname_train)
-        logstr += f"load {len(kp_train)} keypoints for train img from file\n"
+    # features computed by the previous run are reused if the image hasn't been changed
+    query_params = {'kern_size': kern_size, 'detect_scale': detect_scale, 'mask': mask_stamp()}
+    new_features = None
+    cached = train['store'].get(fname_query, query_params)
+    if cached is not None:
+        kp_query_xy, dscr_query = keypoints_xy(cached[0]), cached[1]
+        logstr += f"load {len(kp_query_xy)} keypoints for query img from the feature store\n"
     else:
+        im_queryBlur = im_queryGray
         if kern_size >= 3:
-            im_trainGray = cv2.blur(im_trainGray, (7, 7))
-        kp_train, dscr_train = detector.detectAndCompute(im_trainGray, None)
-        # print(f"\ndscr_train type: {type(dscr_train)}   shape: {dscr_train.shape}   {dscr_train.dtype}\n")
-        logstr += f"found {len(kp_train)} keypoints in train img\n"
-
-        if os.path.isfile('mask.png'):
-            img_map = cv2.imread('mask.png', cv2.IMREAD_COLOR)
-
-            good_kp = []  # List of "good keypoint"
-            good_dsk = []  # List of "good descriptors"
-
-            for k, d in zip(kp_train, dscr_train):
-                x, y = k.pt
-                if img_map[round(y / 2), round(x / 2)][2] == 0:
-                    good_kp.append(k)  # Append keypoint to a list of "good keypoint".
-                    good_dsk.append(d)  # Append descriptor to a list of "good descriptors".
-
-            kp_train, dscr_train = good_kp, np.asarray(good_dsk, dtype=np.uint8)
-            logstr += f"{len(kp_train)} keypoints left after filter using mask\n"
-
-        save_keypoints(kp_train, fname_train)
-        save_descriptors(dscr_train, fname_train)
-
-        # save image with all points
-        # for debug purposes
-        impoints = cv2.drawKeypoints(im_trainGray, kp_train, 0, (0, 0, 255),
-                                     flags=cv2.DRAW_MATCHES_FLAGS_NOT_DRAW_SINGLE_POINTS)
-        cv2.imwrite(fname_train + "_keypoints.jpg", impoints)
+            # print(f"kernel size:", kern_size)
+            with report.stage('blur', fname_query):
+                im_queryBlur = cv2.blur(im_queryGray, (7, 7))
+
+        # Detect AKAZE features and compute descriptors.
+        with report.stage('detect', fname_query):
+            kp_arr, dscr_query, impoints = detect_features(im_queryBlur, detect_scale, train['mask'],
+                                                           train['debug_images'])
+        if train['debug_images']:
+            cv2.imwrite(fname_query + "_keypoints.jpg", impoints)
+        new_features = {'params': query_params,
+                        'keypoints': kp_arr,
+                        'descriptors': dscr_query}
+        kp_query_xy = keypoints_xy(kp_arr)
+        logstr += f"found {len(kp_arr)} keypoints in query img (detection scale 1/{detect_scale})\n"
     print('.', end='', flush=True)
 
     # Match features
-    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
-    # matcher = cv2.BFMatcher(cv2.NORM_L1, crossCheck=False)
-    all_matches = matcher.knnMatch(dscr_query, dscr_train, k=2)
+    # k nearest neighbours search as cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch() does,
+    # but the result is two arrays: distances to and indexes of two nearest train descriptors
+    h_prior = None
+    if train['window'] is not None:
+        prior_kp_xy, prior_dscr = train_prior_features()
+        with report.stage('prior', fname_query):
+            h_prior = prior_homography(im_queryGray, prior_kp_xy, prior_dscr)
+        logstr += "keypoints are matched within the window around " + \
+                  ("the prior homography\n" if h_prior is not None else "their positions (no prior homography)\n")
+    if train['window'] is None and train['matcher'] == 'lsh':
+        # the index is built once per process, it is reported as a stage of its own
+        train_index()
+    with report.stage('match', fname_query):
+        if train['window'] is not None:
+            dist, nidx = knn_match_window(kp_query_xy, dscr_query, kp_train_xy, dscr_train, train['window'], h_prior)
+        elif train['matcher'] == 'lsh':
+            dist, nidx = knn_match_lsh(dscr_query)
+        else:
+            dist, nidx = knn_match(dscr_query, dscr_train)
     print('.', end='', flush=True)
-    logstr += f"{len(all_matches)} matches has been found between images\n"
+    logstr += f"{len(dist)} matches has been found between images\n"
 
     # Refine keypoints 1
-    good_matches_1, kp_1_query, kp_1_train = refine_keypoints_1(all_matches,
-                                                                 im_query,
-                                                                 kp_query,
-                                                                 im_train,
-                                                                 kp_train,
-                                                                 fname_query,
-                                                                 distance_k=0.9,
-                                                                 drawkp=False)
-    print('.', end='', flush=True)
-    logstr += f"{len(good_matches_1)} matches left after first refinement\n"
-
-    # Find homography
-    query_pts = np.float32([kp_query[m.queryIdx].pt for m in good_matches_1]).reshape(-1, 1, 2)
-    train_pts = np.float32([kp_train[m.trainIdx].pt for m in good_matches_1]).reshape(-1, 1, 2)
-    h, mask = cv2.findHomography(query_pts, train_pts, cv2.RANSAC, 5.0)
-    print('.', end='', flush=True)
-
-    # Refine keypoints 2
-    good_matches_2, kp_2_query, kp_2_train = refine_keypoints_2(im_query,
-                                                                kp_1_query,
-                                                                im_train,
-                                                                kp_1_train,
-                                                                fname_query,
-                                                                h,
-                                                                inlier_threshold=12.5,
-                                                                drawkp=False)
+    with report.stage('refine', fname_query):
+        query_idx, train_idx = refine_keypoints_1(dist, nidx, distance_k=0.9)
     print('.', end='', flush=True)
-    logstr += f"{len(good_matches_2)} matches left after second refinement\n"
-
-    # Find homography
-    query_pts2 = np.float32([kp_2_query[m.queryIdx].pt for m in good_matches_2]).reshape(-1, 1, 2)
-    train_pts2 = np.float32([kp_2_train[m.trainIdx].pt for m in good_matches_2]).reshape(-1, 1, 2)
-    h2, mask = cv2.findHomography(query_pts2, train_pts2, cv2.RANSAC, 5.0)
+    logstr += f"{len(query_idx)} matches left after first refinement\n"
+
+    with report.stage('homography', fname_query):
+        # Find homography
+        query_pts = kp_query_xy[query_idx]
+        train_pts = kp_train_xy[train_idx]
+        h, mask = cv2.findHomography(query_pts, train_pts, cv2.RANSAC, 5.0)
+        print('.', end='', flush=True)
+
+        # Refine keypoints 2
+        inliers = refine_keypoints_2(query_pts, train_pts, h, inlier_threshold=12.5)
+        query_pts2 = query_pts[inliers]
+        train_pts2 = train_pts[inliers]
+        print('.', end='', flush=True)
+        logstr += f"{len(query_pts2)} matches left after second refinement\n"
+
+        # Find homography
+        h2, mask = cv2.findHomography(query_pts2, train_pts2, cv2.RANSAC, 5.0)
     print('.', end='', flush=True)
-
+    stats = {'keypoints': len(kp_query_xy),
+             'train_keypoints': len(kp_train_xy),
+             'matches': len(dist),
+             'ratio_test': len(query_idx),
+             'inliers': len(query_pts2),
+             'ransac_inliers': 0 if mask is None else int(mask.sum())}
+
+    # subpixel refinement at full resolution
+    if train['ecc']:
+        with report.stage('ecc', fname_query):
+            try:
+                h2, cc = refine_homography_ecc(im_train, im_queryGray, h2)
+                stats['ecc_cc'] = cc
+                logstr += f"homography refined using ECC, correlation coefficient: {cc}\n"
+            except cv2.error:
+                logstr += "ECC refinement didn't converge, homography from keypoints is used\n"
+        print('.', end='', flush=True)
 
     # save homography for debug purposes
     # with open("matches_" + fname_query + "_homography.txt", "w") as f:
     #     f.write(str(h) + "\n")
     #     f.write(str(h2))
 
-    # Use homography to warp the image
-    height, width, channels = im_train.shape
-
-    # export the image with alpha channel
-    # im_queryReg = cv2.warpPerspective(cv2.imread(fname_query, cv2.IMREAD_UNCHANGED), h2, (width, height))
-    # cv2.imwrite('al_' + fname_query + '.tif', im_queryReg)
-
-    # print(f"\nkp_query: {type(kp_query)} of {len(kp_query)} items")
-    # print(f"query_pts2: {type(query_pts2)} of {len(query_pts2)} items")
-    # print(f"kp_train: {type(kp_train)} of {len(kp_train)} items")
-    # print(f"train_pts2: {type(train_pts2)} of {len(train_pts2)} items")
-
-    # Draw matches
-    # imMatches = cv2.drawMatches(im_query, kp_query, im_train, kp_train, good_matches_2, None)
-    imMatches = cv2.drawMatches(im_query, kp_2_query, im_train, kp_2_train, good_matches_2, None)
-    cv2.imwrite(fname_query + "_matches.jpg", imMatches)
-
-    # export the transformed image
-    # im_queryReg = cv2.warpPerspective(im_query, h2, (width, height))
-    im_queryReg = cv2.warpPerspective(cv2.imread(fname_query, cv2.IMREAD_UNCHANGED), h2, (width, height))
-    cv2.imwrite('al_' + fname_query + '.tif', im_queryReg)
-
-    print('.', end='', flush=True)
-    with open(fname_query + "_log.txt", "w") as f:
-        f.write(logstr)
-
-
-def refine_keypoints_1(all_matches, im_query, kp_query, im_train, kp_train, fname_query, distance_k=0.9, drawkp=True):
-    """refine keypoins based on their distance difference"""
-    # Apply ratio test
-    kp_1_query = []
-    kp_1_train = []
-    matches_for_draw = []
-    good_matches_1 = []
-    for m, n in all_matches:
-        if m.distance < distance_k * n.distance:
-            kp_1_query.append(kp_query[m.queryIdx])
-            kp_1_train.append(kp_train[m.trainIdx])
-            good_matches_1.append(m)
-            if drawkp:
-                matches_for_draw.append([m])
-
     # Draw matches
-    if drawkp:
-        imMatches = cv2.drawMatchesKnn(im_query, kp_query, im_train, kp_train, matches_for_draw, None)
-        cv2.imwrite("matches_" + fname_query + "_1.jpg", imMatches)
-
-    return good_matches_1, kp_1_query, kp_1_train
-
-
-def refine_keypoints_2(im_query, kp_1_query, im_train, kp_1_train, fname_query, h, inlier_threshold=15.0, drawkp=True):
-    """refine keypoints based on distance between them after wrapping the query points using homography"""
+    if train['debug_images']:
+        cv2.imwrite(fname_query + "_matches.jpg", draw_matches(im_query, query_pts2, im_train, train_pts2))
+
+    return {'homography': h2, 'stats': stats, 'features': new_features, 'log': logstr}
+
+
+def train_index():
+    """FLANN LSH index over the train descriptors, built once per process"""
+    if 'index' not in train:
+        with report.stage('index', train['fname']):
+            # the index refers to the descriptors, they are kept as long as the index
+            train['index_descriptors'] = np.ascontiguousarray(train['descriptors'])
+            train['index'] = cv2.flann_Index(train['index_descriptors'], {'algorithm': FLANN_INDEX_LSH,
+                                                                          'table_number': LSH_TABLES,
+                                                                          'key_size': LSH_KEY_SIZE,
+                                                                          'multi_probe_level': LSH_PROBE_LEVEL})
+    return train['index']
+
+
+def prior_scale(im_gray):
+    """the image is reduced this many times for the prior homography estimation"""
+    return max(1.0, max(im_gray.shape[:2]) / WINDOW_PRIOR_SIZE)
+
+
+def train_prior_features():
+    """keypoints and descriptors of the reduced train image (see prior_homography()), detected once per process"""
+    if 'prior_kp_xy' not in train:
+        with report.stage('prior', train['fname']):
+            im_gray = cv2.cvtColor(train['image'], cv2.COLOR_BGR2GRAY)
+            kp_arr, dscr, _ = detect_features(im_gray, prior_scale(im_gray), train['mask'], False)
+        train['prior_kp_xy'], train['prior_descriptors'] = keypoints_xy(kp_arr), dscr
+    return train['prior_kp_xy'], train['prior_descriptors']
+
+
+def prior_homography(im_queryGray, kp_train_xy, dscr_train):
+    """rough homography which maps the query image to the train one, estimated on the keypoints
+    of the images reduced to WINDOW_PRIOR_SIZE (None if it can't be found)"""
+    scale = prior_scale(im_queryGray)
+    kp_arr, dscr_query, _ = detect_features(im_queryGray, scale, train['mask'], False)
+    if dscr_query is None or dscr_train is None or len(dscr_train) < 2:
+        return None
+    dist, nidx = knn_match(dscr_query, dscr_train)
+    query_idx, train_idx = refine_keypoints_1(dist, nidx, distance_k=0.8)
+    if len(query_idx) < 4:
+        return None
+    h, mask = cv2.findHomography(keypoints_xy(kp_arr)[query_idx], kp_train_xy[train_idx], cv2.RANSAC, 3.0 * scale)
+    return h
+
+
+def knn_match(dscr_query, dscr_train, k=2):
+    """k nearest train descriptors for every query descriptor (brute force)
+
+    return two arrays of shape (n, k): distances to and indexes of the nearest train descriptors,
+    the missing neighbours have index -1"""
+    if len(dscr_train) < k:
+        dist = np.full((len(dscr_query), k), np.iinfo(np.int32).max, dtype=np.int32)
+        nidx = np.full((len(dscr_query), k), -1, dtype=np.int32)
+        if len(dscr_train) > 0:
+            dist[:, :len(dscr_train)], nidx[:, :len(dscr_train)] = knn_match(dscr_query, dscr_train, len(dscr_train))
+        return dist, nidx
+    return cv2.batchDistance(dscr_query, dscr_train, cv2.CV_32S, normType=cv2.NORM_HAMMING,
+                             K=k, update=0, crosscheck=False)
+
+
+def knn_match_lsh(dscr_query, k=2):
+    """the same as knn_match() using the LSH index over the train descriptors (approximate)"""
+    dist = np.full((len(dscr_query), k), np.iinfo(np.int32).max, dtype=np.int32)
+    nidx = np.full((len(dscr_query), k), -1, dtype=np.int32)
+    # the index can't look for more neighbours than it has
+    k_index = min(k, len(train['descriptors']))
+    if len(dscr_query) > 0 and k_index > 0:
+        # the neighbours which are not found have index -1 and distance int32 max as above
+        nidx[:, :k_index], dist[:, :k_index] = train_index().knnSearch(np.ascontiguousarray(dscr_query), k_index,
+                                                                      params={'checks': LSH_CHECKS})
+    return dist, nidx
+
+
+def knn_match_window(kp_query_xy, dscr_query, kp_train_xy, dscr_train, window, h_prior=None, k=2):
+    """the same as knn_match() but every query keypoint (mapped by prior homography h_prior)
+    is matched only to the train keypoints in the same and neighbouring square cells of size window"""
+    dist = np.full((len(dscr_query), k), np.iinfo(np.int32).max, dtype=np.int32)
+    nidx = np.full((len(dscr_query), k), -1, dtype=np.int32)
+    if len(kp_query_xy) == 0 or len(kp_train_xy) == 0:
+        return dist, nidx
+    query_xy = kp_query_xy if h_prior is None else \
+        cv2.perspectiveTransform(kp_query_xy.reshape(-1, 1, 2), h_prior).reshape(-1, 2)
+
+    def cells(xy):
+        """unique cells and the list of point indexes in every cell"""
+        keys, inverse = np.unique(np.floor(xy / window).astype(np.int64), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        return keys, np.split(order, np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1])
+
+    train_keys, train_cells = cells(kp_train_xy)
+    train_cells = {(x, y): idx for (x, y), idx in zip(train_keys.tolist(), train_cells)}
+    query_keys, query_cells = cells(query_xy)
+    for (x, y), query_idx in zip(query_keys.tolist(), query_cells):
+        candidates = [train_cells[(x + dx, y + dy)] for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                      if (x + dx, y + dy) in train_cells]
+        if len(candidates) == 0:
+            continue
+        candidates = np.concatenate(candidates)
+        d, n = knn_match(dscr_query[query_idx], dscr_train[candidates], k)
+        dist[query_idx], nidx[query_idx] = d, np.where(n >= 0, candidates[np.maximum(n, 0)], -1)
+    return dist, nidx
+
+
+def parse_window(value):
+    """size of the matching window given by -window=<pixels> option (None if it is not positive number)"""
+    try:
+        window = float(value)
+    except ValueError:
+        return None
+    return window if math.isfinite(window) and window > 0 else None
+
+
+def keypoints_xy(kp_arr):
+    """keypoints coordinates as float32 array of shape (n, 2)"""
+    return np.column_stack((kp_arr['x'], kp_arr['y'])).astype(np.float32)
+
+
+def refine_keypoints_1(dist, nidx, distance_k=0.9):
+    """refine matches based on their distance difference (ratio test)
+
+    dist, nidx - distances to and indexes of two nearest train descriptors for every query descriptor
+    return indexes of query and train keypoints of the good matches"""
+    # queries with less than two neighbours have -1 in nidx
+    valid = nidx[:, 1] >= 0
+    good = valid & (dist[:, 0] < distance_k * dist[:, 1])
+    query_idx = np.flatnonzero(good)
+    return query_idx, nidx[query_idx, 0]
+
+
+def refine_keypoints_2(query_pts, train_pts, h, inlier_threshold=15.0):
+    """refine matches based on distance between them after wrapping the query points using homography
+    return boolean mask of the good matches"""
     # https://docs.opencv.org/3.4/db/d70/tutorial_akaze_matching.html
-    kp_2_query = []
-    kp_2_train = []
-    good_matches_2 = []
-    if drawkp:
-        matches_for_draw2 = []
-    for i, m in enumerate(kp_1_query):
-        if kp_distance(m.pt, kp_1_train[i].pt, h) < inlier_threshold:
-            good_matches_2.append(cv2.DMatch(len(kp_2_query), len(kp_2_train), 0))
-            kp_2_query.append(kp_1_query[i])
-            kp_2_train.append(kp_1_train[i])
-            if drawkp:
-                matches_for_draw2.append([cv2.DMatch(len(kp_2_query), len(kp_2_train), 0)])
-
-    # Draw refined matches
-    if drawkp:
-        im_matches = cv2.drawMatchesKnn(im_query, kp_2_query, im_train, kp_2_train, matches_for_draw2, None)
-        cv2.imwrite("matches_" + fname_query + "_2.jpg", im_matches)
-
-    return good_matches_2, kp_2_query, kp_2_train
-
-
-def kp_distance(pt_query, pt_train, h):
-    col = np.ones((3, 1), dtype=np.float64)
-    col[0:2, 0] = pt_query
-    col = np.dot(h, col)
-    col /= col[2, 0]
-    # dist = sqrt(pow(col[0, 0] - pt_train[0], 2) + pow(col[1, 0] - pt_train[1], 2))
-    return sqrt(pow(col[0, 0] - pt_train[0], 2) + pow(col[1, 0] - pt_train[1], 2))
+    if h is None:
+        return np.zeros(len(query_pts), dtype=bool)
+    pts = np.column_stack((query_pts.astype(np.float64), np.ones(len(query_pts)))) @ h.T
+    pts = pts[:, :2] / pts[:, 2:]
+    return np.hypot(pts[:, 0] - train_pts[:, 0], pts[:, 1] - train_pts[:, 1]) < inlier_threshold
 
 
-if __name__ == '__main__':
-    # if mp.cpu_count() > 2:
-    #     nproc = round(mp.cpu_count() / 4)
-    # else:
-    #     nproc = 1
+def draw_matches(im_query, query_pts, im_train, train_pts):
+    """debug image: query and train images side by side with lines connecting matched points"""
+    height = max(im_query.shape[0], im_train.shape[0])
+    im_matches = np.zeros((height, im_query.shape[1] + im_train.shape[1], 3), dtype=np.uint8)
+    im_matches[:im_query.shape[0], :im_query.shape[1]] = im_query
+    im_matches[:im_train.shape[0], im_query.shape[1]:] = im_train
+    lines = np.stack((query_pts, train_pts + (im_query.shape[1], 0)), axis=1)
+    cv2.polylines(im_matches, np.round(lines).astype(np.int32), False, (0, 255, 0), 1, cv2.LINE_AA)
+    return im_matches
 
-    # memory used:
-    #
-    # 16 Mp jpegs (tiffs x4= 64 Mp), nproc=8: 60 Gb
-    # 30 Mp jpegs (tiffs x4= 120 Mp), nproc=4:
-    nproc = 8
 
+if __name__ == '__main__':
+    mem_budget = default_mem_budget()
+    detect_scale = 1
+    ecc = False
+    save_report = False
+    average = False
+    save_aligned = False
+    upscale = 1
+    matcher = 'bf'
+    window = None
+    aligned_ext = '.tif'
 
     # process the command line arguments
     fnames = []
     for arg in sys.argv[1:]:
-        if os.path.exists(arg):
+        if arg == "--help":
+            print_usage()
+        elif arg.startswith("-mem="):
+            mem_budget = parse_size(arg[5:])
+        elif arg.startswith("-detect-scale="):
+            detect_scale = int(arg[14:])
+        elif arg == "-ecc":
+            ecc = True
+        elif arg == "-report":
+            save_report = True
+        elif arg == "-avg":
+            average = True
+        elif arg == "-save-aligned":
+            save_aligned = True
+        elif arg.startswith("-matcher=") and arg[9:] in ('bf', 'lsh'):
+            matcher = arg[9:]
+        elif arg.startswith("-window="):
+            window = parse_window(arg[8:])
+            if window is None:
+                print(f"\n****Error: the window must be positive number of pixels: {arg}!\n")
+                print_usage()
+        elif arg == "-ppf":
+            aligned_ext = frame_file.FRAME_EXT
+        elif arg.startswith("-upscale="):
+            upscale = int(arg[9:])
+        elif os.path.exists(arg):
             # append image file to images list
             fnames.append(arg)
+        else:
+            print(f"\n****Error: unknown option: {arg}!\n")
+            print_usage()
 
     fnames = sorted(fnames)
     # remove from the list aligned images if they may get into unintentionally
     fnames = [x for x in fnames if x.find("al_") < 0]
+    # and debug images with keypoints and matches (-upscale mode works on jpgs)
+    fnames = [x for x in fnames if not x.endswith(("_keypoints.jpg", "_matches.jpg"))]
+
+    if len(fnames) < 2:
+        print("\n****Error: at least two images must be given as input!\n")
+        print_usage()
 
     fname_train = fnames.pop(0)
-    # copy first image, so it may be averaged with the others
-    os.popen('cp ' + fname_train + ' ' + 'al_000.tif')
+    save_aligned = save_aligned or not average
 
-    # log image size
-    p = subprocess.Popen("exiftool -ImageSize al_000.tif > large_tiff_image_size.log", stdout=subprocess.PIPE, shell=True)
+    # read tags of all images at once
+    meta = stack_metadata([fname_train] + fnames)
 
-    print("Aligning images...", end='', flush=True)
+    if save_aligned and upscale == 1:
+        # copy first image, so it may be averaged with the others
+        if aligned_ext == '.tif' and not frame_file.is_frame_file(fname_train):
+            os.popen('cp ' + fname_train + ' ' + 'al_000.tif')
+        else:
+            frame_file.imwrite('al_000' + aligned_ext, frame_file.imread(fname_train, cv2.IMREAD_UNCHANGED),
+                               meta.tags(fname_train), np.eye(3))
 
-    # start monitoring memory usage
-    # cmd = "cat /proc/meminfo | grep 'MemAvailable' > stack_align_mem.log; while true; do cat /proc/meminfo | grep 'MemFree' >> stack_align_mem.log; echo; sleep 1; done"
-    cmd = "cat /proc/meminfo | grep 'MemAvailable' > stack_align_mem.log; while true; do cat /proc/meminfo | grep 'MemFree' >> stack_align_mem.log; sleep 1; done"
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
+    # log image size
+    with open("large_tiff_image_size.log", "w") as f:
+        width, height = meta.image_size(fname_train)
+        f.write(f"Image Size                      : {width * upscale}x{height * upscale}\n")
 
-    # align first image in queue so keypoints would be saved into file
-    alignImages2(fname_train, fnames.pop(0))
-    pool = mp.Pool(processes=nproc)
-    pool.starmap(alignImages2, zip(repeat(fname_train), fnames))
-    pool.close()
-    pool.join()
+    print("Aligning images...", end='', flush=True)
 
-    # stop monitoring memory usage
-    p.terminate()
+    # detect train image features once and publish them to all workers
+    store = FeatureStore(FEATURES_FNAME)
+    ref = train_features(fname_train, store, detect_scale)
+    im_trainUp = None
+    if upscale != 1 and (save_aligned or average):
+        # the train image is upscaled the same way as the others are
+        with report.stage('warp', fname_train):
+            im_trainUp = warp_frame(ref['image'], np.eye(3), ref['image'].shape[1::-1], upscale,
+                                    warped_frame_array(ref['image'], ref['image'].shape[1::-1], upscale))
+        if save_aligned:
+            with report.stage('encode', fname_train):
+                frame_file.imwrite('al_000' + aligned_ext, im_trainUp, meta.tags(fname_train), scale_matrix(upscale))
+
+    # images aligned by the previous runs to the same reference with the same parameters
+    # are not aligned again
+    manifest = StackManifest()
+    ref_hash = manifest.frame_hash(fname_train)
+    align_params = {'kern_size': ref['kern_size'], 'detect_scale': detect_scale, 'ecc': ecc, 'mask': mask_stamp(),
+                    'upscale': upscale, 'matcher': matcher, 'window': window}
+
+    acc = None
+    accumulated = []
+    if average:
+        # aligned images are added to the accumulator shared by all workers,
+        # the running sum saved by the previous run is continued if possible
+        acc_frames = manifest.accumulated_frames(ref_hash, align_params, [fname_train] + fnames)
+        if acc_frames is not None:
+            with report.stage('decode', ACC_FNAME):
+                partial = load_partial(ACC_FNAME)
+                acc = SharedAccumulator(partial['sum'].shape)
+                acc.load(partial)
+            out_dtype = partial['dtype']
+            accumulated = list(acc_frames)
+            del partial
+        else:
+            # train image goes first as is
+            if im_trainUp is not None:
+                im_trainFull = im_trainUp
+            else:
+                with report.stage('decode', fname_train):
+                    im_trainFull = frame_file.imread(fname_train, cv2.IMREAD_UNCHANGED)
+            if im_trainFull.ndim == 2:
+                im_trainFull = im_trainFull[:, :, np.newaxis]
+            acc = SharedAccumulator(im_trainFull.shape)
+            with report.stage('accumulate', fname_train):
+                acc.add(im_trainFull)
+            out_dtype = im_trainFull.dtype
+            accumulated = [fname_train]
+            del im_trainFull
+    im_trainUp = None
+
+    jobs = []
+    for fname in fnames:
+        if fname in accumulated:
+            # already in the running sum (its al_ file is not written again)
+            continue
+        entry = manifest.aligned_frame(fname, ref_hash, align_params)
+        if entry is not None and not average and manifest.aligned_file_is_valid(entry) and \
+                entry['aligned'] == aligned_fname(fname, aligned_ext):
+            continue
+        # the homography found by the previous run saves the keypoints detection and matching
+        jobs.append((fname_train, fname) if entry is None else (fname_train, fname, entry['homography']))
+    if len(jobs) < len(fnames):
+        print(f"({len(fnames) - len(jobs)} images are up to date)", end='', flush=True)
+
+    ref_blocks, ref_info = share_train_features(ref, ecc, acc, save_aligned, upscale, matcher, window,
+                                               aligned_ext)
+    shared_mem = sum(shm.size for shm in ref_blocks) + (0 if acc is None else acc.nbytes)
+    del ref
+    # workers read the features of unchanged images from the store file
+    store.save()
+    print('.', end='', flush=True)
 
-    os.popen('rm *.keypoints')
-    os.popen('rm *.descriptors.npy')
-    os.popen('rm *_log.txt')
+    def frame_done(i, res):
+        """record the homography as soon as the image is done, so the interrupted run may be continued"""
+        aligned = aligned_fname(res['fname'], aligned_ext) if save_aligned else None
+        manifest.set_frame(res['fname'], fname_train, ref_hash, align_params, res['homography'], res['stats'],
+                           aligned)
+        manifest.save()
+
+    results = []
+    if len(jobs) > 0:
+        # admit as many alignment jobs at once as the memory budget allows
+        estimates = [align_memory_estimate(*geometry, detect_scale, upscale, save_aligned)
+                     for geometry in image_geometry([job[1] for job in jobs])]
+        scheduler = JobScheduler(mem_budget - shared_mem, initializer=init_align_worker, initargs=(ref_info,))
+        print(f"({scheduler.pool_size(estimates)} processes, {round(max(estimates) / GB, 1)} Gb per image, "
+              f"memory budget {round(mem_budget / GB, 1)} Gb)", end='', flush=True)
+        results = scheduler.run(alignImages2, jobs, estimates, on_result=frame_done)
+
+    # keep new features for the next run
+    for res in results:
+        report.extend(res['report'])
+        if res['features'] is not None:
+            store.put(res['fname'], res['features']['params'],
+                      res['features']['keypoints'], res['features']['descriptors'])
+    store.save()
+
+    for shm in ref_blocks:
+        shm.close()
+        shm.unlink()
+
+    if average:
+        accumulated += [res['fname'] for res in results if res['fname'] not in accumulated]
+        # keep the running sum, so the images added to the stack later are just added to it
+        with report.stage('encode', ACC_FNAME):
+            acc.save(ACC_FNAME, out_dtype, accumulated)
+        manifest.set_accumulator(ACC_FNAME, ref_hash, align_params,
+                                 {fname: manifest.frame_hash(fname) for fname in accumulated})
+        output_fname = averaged_image_fname()
+        with report.stage('average', output_fname):
+            im_avg = acc.result(out_dtype, len(accumulated))
+        acc.close(unlink=True)
+        with report.stage('encode', output_fname):
+            cv2.imwrite(output_fname, im_avg)
+        del im_avg
+        # restore metadata from the first jpg
+        finish_averaged_image(output_fname)
+    manifest.save()
+
+    os.popen('rm -f *_log.txt')
     # os.popen('rm *matches.jpg')
 
     print('done', flush=True)
+
+    if save_report:
+        report.save('stack_align')
@@ -7,72 +7,553 @@
 import os
 import sys
 import glob
+import json
+import struct
+import itertools
+from collections import deque
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
 import cv2 as cv
+import frame_file
+from image_metadata import copy_tags
+from job_scheduler import available_cores, default_mem_budget, parse_size
+from run_report import report
 
 
 def print_usage():
     usage_str = """The script combines (averages) several images into one.
-Input images may be 8- or 16-bit images.
+Input images may be 8- or 16-bit images or frame files (.ppf, see frame_file.py)
+which are memory-mapped instead of being decoded.
 
-Usage: stack_avg.py [images list]
+Usage: stack_avg.py [options] [images list] [partial sum files]
 
 Example: stack_avg.py *.tif
+         stack_avg.py -partial=batch1.part al_0*.tif
+         stack_avg.py -partial=batch2.part al_1*.tif
+         stack_avg.py batch1.part batch2.part
+
+Partial sum files (*.part) given as input are merged with the images (frames of the partial
+sums and the images must not repeat).
+
+Options:
+    -median:                  per-pixel median instead of the mean
+    -sigma-clip[=<kappa>]:    per-pixel mean of the values which differ from the mean less than
+                              kappa standard deviations (default kappa is 2.5, iterated)
+    -winsorized[=<fraction>]: per-pixel mean with the given fraction of the lowest and the highest
+                              values replaced by the nearest remaining ones (default 0.1)
+    -mem=<size>:              memory budget, e.g. 24G or 512M (gigabytes if no unit given);
+                              default is 80% of the available memory. In median, sigma-clip and
+                              winsorized modes the images are converted into memory-mapped files
+                              in {FRAMES_DIR}/ and stacked by row bands which fit the budget
+    -partial=<file>:          save partial sum (per-pixel sum of the images and their number)
+                              into the file instead of the averaged image,
+                              the same file may be given as input to add new images to it
+    -sumsq:                   keep per-pixel sum of squares in the partial sum too
+    -prefetch=<n>:            decode up to n images in background threads while the current one
+                              is being processed (default {PREFETCH_DEPTH}, limited by the memory budget)
+    -report:                  save wall time, CPU time and peak memory of every processing stage
+                              into stack_avg_report.json and stack_avg_report.csv
 """
-    print(usage_str)
+    print(usage_str.format(FRAMES_DIR=FRAMES_DIR, PREFETCH_DEPTH=PREFETCH_DEPTH))
     sys.exit(1)
 
 
+# number of images decoded in background threads ahead of the one being processed
+PREFETCH_DEPTH = 2
+
+# frames are summed by row bands of this height, the bands are summed in parallel threads
+AVG_BAND_ROWS = 256
+
+# robust stacking: frames are converted into memory-mapped files in this directory,
+# memory used per sample of the band (the band of all frames, float copy and temporary arrays)
+FRAMES_DIR = 'stack_avg_frames'
+ROBUST_BYTES_PER_SAMPLE = 32
+SIGMA_CLIP_ITERATIONS = 5
+
+# partial sum file format, see save_partial()
+PARTIAL_MAGIC = b'PPSPART1'
+PARTIAL_ALIGN = 4096
+
+
+def averaged_image_fname():
+    """get the filename of the first jpg image in the directory
+    and use this filename (adding suffix) for the output image"""
+    jpegs = sorted(glob.glob(('*.jpg')))
+    if len(jpegs) > 0:
+        return jpegs[0][:-4] + "_averaged.tif"
+    return "00_averaged.tif"
+
+
+def finish_averaged_image(output_fname):
+    """restore metadata from the first jpg and move the image to the parent directory"""
+    jpegs = sorted(glob.glob(('*.jpg')))
+    if os.path.isfile(output_fname) and len(jpegs) > 0:
+        with report.stage('metadata', output_fname):
+            copy_tags(jpegs[0], output_fname)
+        os.system(f"mv {output_fname} ..")
+
+
+class SharedAccumulator:
+    """Per-pixel sum of the frames and per-pixel weight (coverage) in shared memory
+
+    Frames are added by several processes at once, every row band of the accumulator
+    has its own lock, so the processes rarely wait for each other.
+    The coverage of the frame warped with black border is its alpha channel / max alpha,
+    for the frames without alpha channel it must be given explicitly.
+
+    The averaged image: color = sum / weight (pixels are not darkened near the frame borders),
+    alpha = sum / number of frames."""
+
+    N_BANDS = 16
+
+    def __init__(self, shape, info=None):
+        """create new accumulator for the frames of given shape (height, width, channels)
+        or attach the existing one using its info"""
+        if info is None:
+            height, width, channels = shape
+            self.blocks = [shared_memory.SharedMemory(create=True, size=height * width * channels * 8),
+                           shared_memory.SharedMemory(create=True, size=height * width * 8)]
+            for shm in self.blocks:
+                np.ndarray((shm.size,), dtype=np.uint8, buffer=shm.buf)[:] = 0
+            self.info = {'shape': shape,
+                         'blocks': [shm.name for shm in self.blocks],
+                         'locks': [mp.Lock() for i in range(self.N_BANDS)]}
+        else:
+            self.blocks = [shared_memory.SharedMemory(name=name) for name in info['blocks']]
+            self.info = info
+        self.shape = tuple(self.info['shape'])
+        self.sum = np.ndarray(self.shape, dtype=np.float64, buffer=self.blocks[0].buf)
+        self.weight = np.ndarray(self.shape[:2], dtype=np.float64, buffer=self.blocks[1].buf)
+        self.bands = np.linspace(0, self.shape[0], self.N_BANDS + 1).astype(int)
+
+    @property
+    def nbytes(self):
+        return self.sum.nbytes + self.weight.nbytes
+
+    def add(self, img, coverage=None, origin=(0, 0)):
+        """add the frame (or its tile with the top left corner at origin (y, x))
+        to the sum and its coverage to the weight"""
+        img = img.reshape(img.shape[:2] + self.shape[2:])
+        if coverage is None:
+            coverage = frame_coverage(img)
+        y, x = origin
+        height, width = img.shape[:2]
+        for lock, y0, y1 in zip(self.info['locks'], self.bands[:-1], self.bands[1:]):
+            y0, y1 = max(y0, y), min(y1, y + height)
+            if y0 >= y1:
+                continue
+            band = img[y0 - y:y1 - y].astype(np.float64)
+            band_coverage = coverage[y0 - y:y1 - y].astype(np.float64)
+            with lock:
+                self.sum[y0:y1, x:x + width] += band
+                self.weight[y0:y1, x:x + width] += band_coverage
+
+    def result(self, dtype, nframes):
+        """averaged image of nframes frames"""
+        out = np.zeros(self.shape, dtype=dtype)
+        for y0, y1 in zip(self.bands[:-1], self.bands[1:]):
+            weight = self.weight[y0:y1, :, np.newaxis]
+            band = np.divide(self.sum[y0:y1], weight, out=np.zeros_like(self.sum[y0:y1]), where=weight > 0)
+            if self.shape[2] == 4:
+                band[..., 3] = self.sum[y0:y1, :, 3] / nframes
+            out[y0:y1] = mean_to_dtype(band, dtype)
+        return out.squeeze()
+
+    def save(self, fname, dtype, frames):
+        """save the accumulator into partial sum file, see save_partial()"""
+        save_partial(fname, {'sum': self.sum, 'weight': self.weight}, dtype, frames)
+
+    def load(self, partial):
+        """replace the accumulator content with the partial sum loaded by load_partial()"""
+        self.sum[...] = partial['sum'].reshape(self.shape)
+        self.weight[...] = partial['weight']
+
+    def close(self, unlink=False):
+        self.sum = self.weight = None
+        for shm in self.blocks:
+            shm.close()
+            if unlink:
+                shm.unlink()
+
+
+def save_partial(fname, arrays, dtype, frames, weighting='coverage'):
+    """save partial sum file
+
+    arrays:    {'sum': per-pixel sum of the frames, 'weight': per-pixel weight, ['sumsq': sum of squares]}
+    dtype:     type of the frames (the type of the averaged image)
+    frames:    list of the frames in the sum
+    weighting: 'coverage' - weight is the coverage of the warped frames (stack_align.py -avg),
+               'count' - weight is the number of frames (stack_avg.py -partial)
+
+    File layout: PARTIAL_MAGIC, 8 bytes little endian length of JSON header, JSON header,
+    raw C-order arrays each starting at multiple of PARTIAL_ALIGN (so they can be memory-mapped)"""
+    header = {'dtype': np.dtype(dtype).str, 'frames': frames, 'weighting': weighting, 'arrays': {}}
+    offset = 0
+    for name, arr in arrays.items():
+        header['arrays'][name] = {'offset': offset, 'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+        offset += arr.nbytes + (-arr.nbytes % PARTIAL_ALIGN)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = partial_data_offset(len(header_bytes))
+
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(PARTIAL_MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, arr in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(arr).data)
+    os.replace(tmp_fname, fname)
+
+
+def load_partial(fname):
+    """load partial sum file saved by save_partial(), arrays are memory-mapped (read-only)
+
+    return {'dtype': type of the frames, 'frames': list of the frames, 'weighting': see save_partial(),
+            <array name>: array, ...}"""
+    with open(fname, 'rb') as f:
+        if f.read(len(PARTIAL_MAGIC)) != PARTIAL_MAGIC:
+            raise ValueError(f"{fname} is not a partial sum file")
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = partial_data_offset(header_len)
+    partial = {'dtype': np.dtype(header['dtype']), 'frames': header['frames'],
+               'weighting': header.get('weighting', 'coverage')}
+    for name, arr in header['arrays'].items():
+        partial[name] = np.memmap(fname, dtype=np.dtype(arr['dtype']), mode='r',
+                                  offset=data_start + arr['offset'], shape=tuple(arr['shape']))
+    return partial
+
+
+def partial_data_offset(header_len):
+    header_len += len(PARTIAL_MAGIC) + 8
+    return header_len + (-header_len % PARTIAL_ALIGN)
+
+
+def prefetch_frames(images_list, depth=PREFETCH_DEPTH):
+    """decode the images in background threads up to depth images ahead of the one being processed,
+    yield (file name, image) in the order of images_list
+
+    Up to depth + 1 decoded images are held in memory at once."""
+    def decode(fname):
+        with report.stage('decode', fname):
+            return frame_file.imread(fname, cv.IMREAD_UNCHANGED)
+
+    depth = max(1, depth)
+    fnames = iter(images_list)
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        queue = deque((fname, executor.submit(decode, fname)) for fname in itertools.islice(fnames, depth))
+        while len(queue) > 0:
+            fname, future = queue.popleft()
+            img = future.result()
+            for next_fname in itertools.islice(fnames, 1):
+                queue.append((next_fname, executor.submit(decode, next_fname)))
+            yield fname, img
+
+
+def prefetch_depth(depth, frame_nbytes, mem_budget):
+    """prefetch depth limited by the number of frames which fit the memory budget"""
+    return max(1, min(depth, int(mem_budget // max(1, frame_nbytes)) - 1))
+
+
+def check_frame(img, fname, shape, dtype, first_fname):
+    """all the images of the stack must be of the same size and type"""
+    if img is None or img.shape != shape or img.dtype != dtype:
+        raise ValueError(f"{fname} can't be read or differs from {first_fname} in size or type")
+
+
+def mean_to_dtype(mean, dtype):
+    """float image -> image of given type (rounded and clipped to the range of the type)"""
+    if np.issubdtype(dtype, np.integer):
+        return np.clip(np.rint(mean), 0, np.iinfo(dtype).max).astype(dtype)
+    return np.clip(mean, 0, 1.0).astype(dtype)
+
+
+def frame_coverage(img):
+    """part of the pixel covered by the frame: alpha / max alpha (ones if there is no alpha channel)"""
+    if img.ndim == 3 and img.shape[2] == 4:
+        maxval = np.iinfo(img.dtype).max if np.issubdtype(img.dtype, np.integer) else 1.0
+        return img[..., 3].astype(np.float32) / maxval
+    return np.ones(img.shape[:2], dtype=np.float32)
+
+
 class AvgImages:
-    """average number of images and save result into separate file"""
-    def __init__(self, images_list, averaged_image_fname):
+    """average number of images and save result into separate file
+
+    The frames are summed into float64 accumulator by row bands in parallel threads
+    and the sum is converted to the type of the frames once at the end. The sums of
+    integer pixel values are exact, so the result does not depend on the number of
+    frames, threads or bands, and the partial sums of different parts of the stack
+    are merged exactly.
+
+    partials      - partial sum files (see save_partial()) the images are added to
+    partial_fname - save the partial sum into this file instead of the averaged image
+    sumsq         - keep per-pixel sum of squares in the partial sum too"""
+    def __init__(self, images_list, averaged_image_fname, nthreads=None, prefetch=PREFETCH_DEPTH,
+                 mem_budget=None, partials=(), partial_fname=None, sumsq=False):
         print(f"Averaging {len(images_list)} images...", end='', flush=True)
+        nthreads = nthreads if nthreads is not None else available_cores()
+        mem_budget = mem_budget if mem_budget is not None else default_mem_budget()
 
-        # rolling average the images
-        out_image = cv.imread(images_list[0], cv.IMREAD_UNCHANGED)
-        # convert the image to 16bit if the input is 8bit
-        # if out_image.dtype == 'uint8':
-        #     out_image = out_image.astype('uint16') * 257
-        print(out_image.dtype)
-        for i in range(1, len(images_list)):
-            img = cv.imread(images_list[i], cv.IMREAD_UNCHANGED)
-            # convert the image to 16bit if the input is 8bit
-            # if img.dtype == 'uint8':
-            #     img = img.astype('uint16') * 257
-            alpha = 1.0 / float(i + 1)
-            # print(str(round(1 - alpha, 4)).ljust(6), str(round(alpha, 4)).ljust(6))
-            print(".", end='', flush=True)
-            out_image = cv.addWeighted(img, alpha, out_image, 1 - alpha, 0.0)
-        cv.imwrite(averaged_image_fname, out_image)
+        loaded = [load_partial(fname) for fname in partials]
+        img = None
+        if len(images_list) > 0:
+            with report.stage('decode', images_list[0]):
+                img = frame_file.imread(images_list[0], cv.IMREAD_UNCHANGED)
+            shape, dtype = img.shape, img.dtype
+        else:
+            shape, dtype = loaded[0]['sum'].shape, loaded[0]['dtype']
+        print(dtype)
+        acc_sum = np.zeros(shape, dtype=np.float64)
+        acc_sumsq = np.zeros(shape, dtype=np.float64) if sumsq else None
+        weight = np.zeros(shape[:2], dtype=np.float64)
+        frames = []
+
+        # merge the partial sums
+        for fname, partial in zip(partials, loaded):
+            if partial['weighting'] != 'count':
+                raise ValueError(f"{fname} is not a partial sum of stack_avg.py")
+            if partial['sum'].shape != shape or partial['dtype'] != dtype:
+                raise ValueError(f"{fname} differs from the other images in size or type")
+            if sumsq and 'sumsq' not in partial:
+                raise ValueError(f"{fname} has no sum of squares")
+            repeated = set(frames + images_list) & set(partial['frames'])
+            if len(repeated) > 0:
+                raise ValueError(f"{fname} contains the frames which have been added already: {sorted(repeated)}")
+            with report.stage('merge', fname):
+                acc_sum += partial['sum']
+                weight += partial['weight']
+                if sumsq:
+                    acc_sumsq += partial['sumsq']
+            frames += partial['frames']
+        loaded = None
+
+        bands = [(y0, min(y0 + AVG_BAND_ROWS, shape[0])) for y0 in range(0, shape[0], AVG_BAND_ROWS)]
+
+        def add_band(y0, y1):
+            # numpy releases GIL, so the bands are summed in parallel
+            np.add(acc_sum[y0:y1], img[y0:y1], out=acc_sum[y0:y1])
+            if sumsq:
+                np.add(acc_sumsq[y0:y1], np.square(img[y0:y1], dtype=np.float64), out=acc_sumsq[y0:y1])
+
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            if img is not None:
+                with report.stage('average', images_list[0]):
+                    list(executor.map(lambda band: add_band(*band), bands))
+                # the next images are decoded while the current one is added
+                acc_nbytes = acc_sum.nbytes * (1 + sumsq) + weight.nbytes
+                prefetch = prefetch_depth(prefetch, img.nbytes, mem_budget - acc_nbytes - img.nbytes)
+                for fname, img in prefetch_frames(images_list[1:], prefetch):
+                    check_frame(img, fname, shape, dtype, images_list[0])
+                    print(".", end='', flush=True)
+                    with report.stage('average', fname):
+                        list(executor.map(lambda band: add_band(*band), bands))
+                img = None
+            # every image covers the whole frame
+            weight += len(images_list)
+            frames += images_list
+
+            if partial_fname is not None:
+                arrays = {'sum': acc_sum, 'weight': weight}
+                if sumsq:
+                    arrays['sumsq'] = acc_sumsq
+                with report.stage('encode', partial_fname):
+                    save_partial(partial_fname, arrays, dtype, frames, weighting='count')
+                print("done")
+                return
+
+            # convert the mean into the type of the frames once
+            out_image = np.empty(shape, dtype=dtype)
+            weight = weight.reshape(shape[:2] + (1,) * (len(shape) - 2))
+
+            def convert_band(y0, y1):
+                band = np.divide(acc_sum[y0:y1], weight[y0:y1], out=np.zeros_like(acc_sum[y0:y1]),
+                                 where=weight[y0:y1] > 0)
+                out_image[y0:y1] = mean_to_dtype(band, dtype)
+
+            with report.stage('average', averaged_image_fname):
+                list(executor.map(lambda band: convert_band(*band), bands))
+        with report.stage('encode', averaged_image_fname):
+            cv.imwrite(averaged_image_fname, out_image)
+        print("done")
+
+
+def median(samples):
+    """per-pixel median of the samples (frames along the first axis)"""
+    return np.median(samples, axis=0)
+
+
+def sigma_clipped_mean(samples, kappa=2.5, iterations=SIGMA_CLIP_ITERATIONS):
+    """per-pixel mean of the samples which differ from the mean less than kappa standard deviations,
+    the mean and the deviation are computed again for the remaining samples until nothing is rejected"""
+    data = samples.astype(np.float32)
+    keep = np.ones(data.shape, dtype=bool)
+    for i in range(iterations):
+        n = np.maximum(keep.sum(axis=0), 1)
+        mean = np.where(keep, data, 0).sum(axis=0) / n
+        dev = data - mean
+        std = np.sqrt(np.where(keep, dev * dev, 0).sum(axis=0) / n)
+        new_keep = np.abs(dev) <= kappa * std
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+    # all the samples of the pixel are used if every one has been rejected
+    keep |= ~keep.any(axis=0)
+    return np.where(keep, data, 0).sum(axis=0) / keep.sum(axis=0)
+
+
+def winsorized_mean(samples, fraction=0.1):
+    """per-pixel mean with the fraction of the lowest and the highest samples
+    replaced by the nearest remaining ones"""
+    data = np.sort(samples, axis=0)
+    k = int(len(data) * fraction)
+    if 0 < k < len(data) - k:
+        data[:k] = data[k]
+        data[len(data) - k:] = data[len(data) - k - 1]
+    return data.mean(axis=0, dtype=np.float64)
+
+
+# robust stacking modes of stack_avg.py
+ESTIMATORS = {'median': median, 'sigma-clip': sigma_clipped_mean, 'winsorized': winsorized_mean}
+
+
+class RobustStackImages:
+    """combine number of images by per-pixel robust estimator (median, sigma_clipped_mean, winsorized_mean)
+    and save result into separate file
+
+    All the samples of the pixel are needed at once, so the images are converted into memory-mapped files
+    and stacked by row bands: every band holds the rows of all the images and fits the memory budget,
+    columns of the band are processed in parallel threads."""
+    def __init__(self, images_list, averaged_image_fname, estimator, estimator_args=(), mem_budget=None,
+                 nthreads=None, prefetch=PREFETCH_DEPTH):
+        print(f"Stacking {len(images_list)} images ({estimator.__name__})...", end='', flush=True)
+        mem_budget = mem_budget if mem_budget is not None else default_mem_budget()
+        nthreads = nthreads if nthreads is not None else available_cores()
+
+        frames = self.map_frames(images_list, prefetch, mem_budget)
+        shape, dtype = frames[0].shape, frames[0].dtype
+        out_image = np.empty(shape, dtype=dtype)
+        row_bytes = len(frames) * int(np.prod(shape[1:])) * ROBUST_BYTES_PER_SAMPLE
+        band_rows = max(1, int((mem_budget - out_image.nbytes) // row_bytes))
+        columns = np.linspace(0, shape[1], nthreads + 1).astype(int)
+
+        def stack_columns(band, y0, x0, x1):
+            combined = estimator(band[:, :, x0:x1], *estimator_args)
+            out_image[y0:y0 + len(band[0]), x0:x1] = mean_to_dtype(combined, dtype)
+
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            for y0 in range(0, shape[0], band_rows):
+                with report.stage('read', f"rows {y0}+{band_rows}"):
+                    band = np.stack([frame[y0:y0 + band_rows] for frame in frames])
+                with report.stage('stack', f"rows {y0}+{band_rows}"):
+                    list(executor.map(lambda x: stack_columns(band, y0, *x), zip(columns[:-1], columns[1:])))
+                del band
+                print(".", end='', flush=True)
+        frames = None
+        self.remove_frames(images_list)
+
+        with report.stage('encode', averaged_image_fname):
+            cv.imwrite(averaged_image_fname, out_image)
         print("done")
 
+    @staticmethod
+    def map_frames(images_list, prefetch=PREFETCH_DEPTH, mem_budget=None):
+        """decode every image once into raw .npy file in FRAMES_DIR, return memory-mapped frames
+        (frame files are memory-mapped as they are)"""
+        os.makedirs(FRAMES_DIR, exist_ok=True)
+        frames = []
+        with report.stage('decode', images_list[0]):
+            first = frame_file.imread(images_list[0], cv.IMREAD_UNCHANGED)
+        shape, dtype = first.shape, first.dtype
+        if mem_budget is not None:
+            prefetch = prefetch_depth(prefetch, first.nbytes, mem_budget - first.nbytes)
+        decoded = itertools.chain([(images_list[0], first)], prefetch_frames(images_list[1:], prefetch))
+        del first
+        for fname, img in decoded:
+            check_frame(img, fname, shape, dtype, images_list[0])
+            if frame_file.is_frame_file(fname):
+                frames.append(img)
+                print(".", end='', flush=True)
+                continue
+            with report.stage('cache', fname):
+                frame = np.lib.format.open_memmap(os.path.join(FRAMES_DIR, fname + '.npy'), mode='w+',
+                                                  dtype=img.dtype, shape=img.shape)
+                frame[...] = img
+                frame.flush()
+            del frame, img
+            frames.append(np.load(os.path.join(FRAMES_DIR, fname + '.npy'), mmap_mode='r'))
+            print(".", end='', flush=True)
+        return frames
+
+    @staticmethod
+    def remove_frames(images_list):
+        for fname in images_list:
+            if not frame_file.is_frame_file(fname):
+                os.remove(os.path.join(FRAMES_DIR, fname + '.npy'))
+        if len(os.listdir(FRAMES_DIR)) == 0:
+            os.rmdir(FRAMES_DIR)
+
 
 if __name__ == '__main__':
 
-    output_fname = ''
+    save_report = False
+    estimator = None
+    mem_budget = default_mem_budget()
+    prefetch = PREFETCH_DEPTH
+    partial_fname = None
+    sumsq = False
     fnames = []
+    partials = []
     for arg in sys.argv[1:]:
         if arg == "--help":
             print_usage()
-        if os.path.exists(arg):
+        if arg == "-report":
+            save_report = True
+        elif arg == "-median":
+            estimator, estimator_args = 'median', ()
+        elif arg == "-sigma-clip" or arg.startswith("-sigma-clip="):
+            estimator, estimator_args = 'sigma-clip', tuple(float(x) for x in arg[12:].split(',') if x)
+        elif arg == "-winsorized" or arg.startswith("-winsorized="):
+            estimator, estimator_args = 'winsorized', tuple(float(x) for x in arg[12:].split(',') if x)
+        elif arg.startswith("-mem="):
+            mem_budget = parse_size(arg[5:])
+        elif arg.startswith("-prefetch="):
+            prefetch = int(arg[10:])
+        elif arg.startswith("-partial="):
+            partial_fname = arg[9:]
+        elif arg == "-sumsq":
+            sumsq = True
+        elif arg.endswith(".part") and os.path.isfile(arg):
+            partials.append(arg)
+        elif os.path.exists(arg):
             # append image file to images list
             fnames.append(arg)
 
-    if len(fnames) < 2:
+    if len(fnames) + len(partials) < (1 if partial_fname is not None else 2):
         print("\n****Error: at least two images must be given as input!\n")
         sys.exit(1)
+    if estimator is not None and (len(partials) > 0 or partial_fname is not None):
+        print("\n****Error: partial sums may be used with the mean only!\n")
+        sys.exit(1)
 
-    # get the filename of the first jpg image in the directory
-    # and use this filename (adding suffix) for the output image
-    jpegs = sorted(glob.glob(('*.jpg')))
-    if len(jpegs) > 0:
-        output_fname = jpegs[0][:-4] + "_averaged.tif"
-    else:
-        output_fname = "00_averaged.tif"
+    output_fname = averaged_image_fname()
 
     # do the job!
-    AvgImages(fnames, output_fname)
+    if estimator is None:
+        AvgImages(fnames, output_fname, prefetch=prefetch, mem_budget=mem_budget,
+                  partials=partials, partial_fname=partial_fname, sumsq=sumsq)
+        if partial_fname is not None:
+            # there is no image to finish
+            output_fname = None
+    else:
+        RobustStackImages(fnames, output_fname, ESTIMATORS[estimator], estimator_args, mem_budget,
+                          prefetch=prefetch)
 
     # restore metadata from the first jpg
-    if os.path.isfile(output_fname) and len(jpegs) > 0:
-        os.system(f"exiftool -TagsFromFile {jpegs[0]} \"-all:all>all:all\" --Orientation -overwrite_original {output_fname} > /dev/null 2>&1")
-        os.system(f"mv {output_fname} ..")
+    if output_fname is not None:
+        finish_averaged_image(output_fname)
+
+    if save_report:
+        report.save('stack_avg')
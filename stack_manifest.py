@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+#
+# Version: 2026.10.18
+# Author: Serhiy Kobyakov
+
+
+import hashlib
+import json
+import os
+from image_metadata import file_stamp
+
+MANIFEST_FNAME = 'stack_align_manifest.json'
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def content_hash(fname):
+    """blake2b hash of the file content"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(fname, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StackManifest:
+    """What has been done with every image of the stack by stack_align.py
+
+    frames:      {image: {hash, reference, reference_hash, params, homography, stats, aligned, aligned_stamp}}
+                 homography maps the image to the reference one, aligned is the name of al_*.tif file
+    accumulator: {fname, reference_hash, params, frames: {image: hash}} - running sum saved by -avg mode
+    hashes:      {file: {stamp, hash}} - content hashes are computed again only for changed files"""
+
+    def __init__(self, fname=MANIFEST_FNAME):
+        self.fname = fname
+        self.data = {'frames': {}, 'accumulator': None, 'hashes': {}}
+        if os.path.isfile(fname):
+            try:
+                with open(fname, 'r') as f:
+                    self.data.update(json.load(f))
+            except (ValueError, OSError):
+                print(f"\n***Warning: can't read {fname}, all images will be aligned again")
+
+    def save(self):
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(self.data, f, indent=1)
+        os.replace(tmp_fname, self.fname)
+
+    def frame_hash(self, fname):
+        """content hash of the file (taken from the manifest if the file size and mtime are the same)"""
+        stamp = file_stamp(fname)
+        cached = self.data['hashes'].get(fname)
+        if cached is None or cached['stamp'] != stamp:
+            cached = {'stamp': stamp, 'hash': content_hash(fname)}
+            self.data['hashes'][fname] = cached
+        return cached['hash']
+
+    def aligned_frame(self, fname, ref_hash, params):
+        """manifest entry of the image if it has been aligned to the same reference
+        with the same parameters and hasn't been changed since then, None otherwise"""
+        entry = self.data['frames'].get(fname)
+        if entry is None or entry['reference_hash'] != ref_hash or entry['params'] != params or \
+                entry['homography'] is None or entry['hash'] != self.frame_hash(fname):
+            return None
+        return entry
+
+    def aligned_file_is_valid(self, entry):
+        """al_*.tif file written for the manifest entry still exists unchanged"""
+        return entry['aligned'] is not None and os.path.isfile(entry['aligned']) and \
+            entry['aligned_stamp'] == file_stamp(entry['aligned'])
+
+    def set_frame(self, fname, ref_fname, ref_hash, params, homography, stats, aligned=None):
+        entry = self.data['frames'].get(fname, {})
+        if entry.get('hash') != self.frame_hash(fname) or entry.get('reference_hash') != ref_hash:
+            entry = {'aligned': None, 'aligned_stamp': None}
+        entry.update({'hash': self.frame_hash(fname),
+                      'reference': ref_fname,
+                      'reference_hash': ref_hash,
+                      'params': params,
+                      'homography': homography})
+        if stats is not None:
+            entry['stats'] = stats
+        if aligned is not None and os.path.isfile(aligned):
+            entry['aligned'], entry['aligned_stamp'] = aligned, file_stamp(aligned)
+        self.data['frames'][fname] = entry
+
+    def accumulated_frames(self, ref_hash, params, fnames):
+        """frames in the saved running sum if it can be continued, None otherwise
+
+        The sum can be continued if it has been made with the same reference and parameters,
+        all its frames are still in the stack and none of them has been changed."""
+        acc = self.data['accumulator']
+        if acc is None or not os.path.isfile(acc['fname']) or \
+                acc['reference_hash'] != ref_hash or acc['params'] != params:
+            return None
+        for fname, frame_hash in acc['frames'].items():
+            if fname not in fnames or not os.path.isfile(fname) or self.frame_hash(fname) != frame_hash:
+                return None
+        return acc['frames']
+
+    def set_accumulator(self, fname, ref_hash, params, frames):
+        self.data['accumulator'] = {'fname': fname, 'reference_hash': ref_hash, 'params': params, 'frames': frames}
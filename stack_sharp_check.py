@@ -9,12 +9,39 @@ min_sigma = 0.5
 
 import os
 import sys
-import subprocess
-from itertools import repeat
+import json
+import glob
+import time
+import bisect
+import math
 import cv2
 import multiprocessing as mp
 import statistics as stat
 import matplotlib.pyplot as plt
+from image_metadata import stack_metadata, file_stamp
+from run_report import report
+
+# sharpness of the images is kept in this file between the runs
+SHARPNESS_CACHE_FNAME = 'stack_sharp_check.json'
+
+# kernel sizes of the gaussian blur of noisy images and of the laplacian
+BLUR_KSIZE = 3
+LAPLACIAN_KSIZE = 9
+
+# -fast mode: quick estimation on the images decoded at 1/4 of their size (jpeg decoder does it
+# almost for free) is kept in its own cache file; the full estimation is made only for the images
+# which quick sharpness is within QUICK_MARGIN standard deviations from the rejection threshold
+# and for QUICK_CALIBRATION images which map the quick values onto the full ones
+QUICK_CACHE_FNAME = 'stack_sharp_check_quick.json'
+QUICK_LAPLACIAN_KSIZE = 3
+QUICK_MARGIN = 1.5
+QUICK_CALIBRATION = 8
+
+# -watch mode: the directory is checked for new images every WATCH_INTERVAL seconds,
+# the blurred images are flagged when at least WATCH_MIN_IMAGES have been checked
+WATCH_INTERVAL = 1.0
+WATCH_MIN_IMAGES = 10
+WATCH_IDLE_TIMEOUT = 60
 
 
 def print_usage():
@@ -29,8 +56,19 @@ Options:
     -index (short: -i):       add the laplacian sharpness estimation as a prefix to the image
                               attention! this would change the images filenames
     -plot-distribution (-pd): save distribution plot of estimated values
+    -fast:                    estimate sharpness of all the images on reduced images first,
+                              only the images close to the rejection threshold (and a few
+                              others for calibration) are checked at full resolution
+    -watch[=<seconds>]:       check the jpg images in the working directory as they appear there
+                              (e.g. being copied from the camera) and flag the blurred ones at once;
+                              stop when no new image appears for given time (default {WATCH_IDLE_TIMEOUT} s);
+                              only -no-cache and -report can be used with it, no images list
+    -no-cache:                estimate sharpness of all the images again, not only of the new
+                              and changed ones (the values are kept in stack_sharp_check.json)
+    -report:                  save wall time, CPU time and peak memory of every processing stage
+                              into stack_sharp_check_report.json and stack_sharp_check_report.csv
 """
-    print(usage_str)
+    print(usage_str.format(WATCH_IDLE_TIMEOUT=WATCH_IDLE_TIMEOUT))
     sys.exit(1)
 
 
@@ -38,25 +76,82 @@ def sigma_estimate(image_path):
     """Estimate sigma parameter of gaussian blur based on the image ISO.
     This estimation is purely empirical and tailored for my LG V30 camera images"""
     print('.', end='', flush=True)
-    iso = int(subprocess.check_output(f"exiftool -ISO -n -s -s -s {image_path}", shell=True))
+    iso = int(stack_metadata().get(image_path, 'ISO'))
     print('.', end='', flush=True)
     return 3.5e-5 * pow(iso, 2) + 2e-3 * iso + 0.3
 
 
+def metric_params(sigma):
+    """parameters the sharpness estimation depends on"""
+    return {'sigma': sigma, 'min_sigma': min_sigma, 'blur_ksize': BLUR_KSIZE, 'laplacian_ksize': LAPLACIAN_KSIZE}
+
+
+class SharpnessCache:
+    """Sharpness of the images estimated by the previous runs
+
+    The entry is valid while the image size and mtime and the estimation parameters are the same."""
+
+    def __init__(self, fname=SHARPNESS_CACHE_FNAME):
+        self.fname = fname
+        self.cache = {}
+        if os.path.isfile(fname):
+            try:
+                with open(fname, 'r') as f:
+                    self.cache = json.load(f)
+            except (ValueError, OSError):
+                self.cache = {}
+
+    def get(self, image_path, params):
+        """sharpness of the image (None if it hasn't been estimated with the same parameters)"""
+        entry = self.cache.get(image_path)
+        if entry is None or entry['params'] != params or entry['stamp'] != file_stamp(image_path):
+            return None
+        return entry['sharpness']
+
+    def put(self, image_path, params, sharpness):
+        self.cache[image_path] = {'stamp': file_stamp(image_path), 'params': params, 'sharpness': sharpness}
+
+    def rename(self, image_path, new_path):
+        """the image has been renamed (mv keeps the size and mtime)"""
+        if image_path in self.cache:
+            self.cache[new_path] = self.cache.pop(image_path)
+
+    def save(self):
+        # interrupted write must not leave truncated cache, so the new one replaces it when it is complete
+        tmp_fname = f"{self.fname}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_fname, 'w') as f:
+                json.dump(self.cache, f, indent=1)
+            os.replace(tmp_fname, self.fname)
+        except OSError:
+            pass
+
+
 def get_sharpness_metric(*params):
-    """Estimate image sharpness"""
+    """Estimate image sharpness, return {'fname', 'sharpness', 'report'}"""
     jpg_filepath, sigma = params[0], params[1]
 
-    img = cv2.imread(jpg_filepath)
+    with report.stage('decode', jpg_filepath):
+        img = cv2.imread(jpg_filepath)
+
+    variance = laplacian_sharpness(img, sigma, jpg_filepath)
+    print('.', end='', flush=True)
+    return {'fname': jpg_filepath, 'sharpness': variance, 'report': report.pop_records()}
+
+
+def laplacian_sharpness(img, sigma, jpg_filepath=''):
+    """Sharpness of the decoded image: laplacian variance of the image denoised according to sigma"""
     imggray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
     # denoise and blur image if there is too much noise
     if sigma > min_sigma:
         # img_to_work = cv2.GaussianBlur(imggray, (3, 3), 0)
-        img_to_work_0 = cv2.fastNlMeansDenoising(imggray, 0.4 * sigma)
+        with report.stage('denoise', jpg_filepath):
+            img_to_work_0 = cv2.fastNlMeansDenoising(imggray, 0.4 * sigma)
         # print(f"img type: {img.dtype}, imggray type: {imggray.dtype}, img_to_work_0 type: {img_to_work_0.dtype}")
         # img_to_work = cv2.GaussianBlur(cv2.fastNlMeansDenoising(imggray, 15), (sigma, sigma), 0)
-        img_to_work = cv2.GaussianBlur(img_to_work_0, (3, 3), sigma)
+        with report.stage('blur', jpg_filepath):
+            img_to_work = cv2.GaussianBlur(img_to_work_0, (BLUR_KSIZE, BLUR_KSIZE), sigma)
         print('*', end='', flush=True)
     else:
         img_to_work = imggray
@@ -64,14 +159,196 @@ def get_sharpness_metric(*params):
     # save blurred image for testing purposes
     # cv2.imwrite(jpg_filepath + "_.jpg", img_to_work)
 
-    variance = cv2.Laplacian(img_to_work, cv2.CV_64F, ksize=9).var()
+    with report.stage('laplacian', jpg_filepath):
+        variance = cv2.Laplacian(img_to_work, cv2.CV_64F, ksize=LAPLACIAN_KSIZE).var()
     # variance = cv2.Laplacian(cv2.cvtColor(cv2.imread(jpg_filepath), cv2.COLOR_BGR2GRAY), cv2.CV_64F, ksize=9).var()
     # numpy.max(cv2.convertScaleAbs(cv2.Laplacian(gray, 3)))
+    return variance
+
+
+def quick_metric_params():
+    return {'reduction': 4, 'laplacian_ksize': QUICK_LAPLACIAN_KSIZE}
+
 
-    with open("0_sharp_check.csv", "a") as f:
-        f.write(jpg_filepath + ";" + str(variance) + "\n")
-        # f.write(str(variance) + "\n")
+def get_quick_metric(jpg_filepath):
+    """Quick estimation of image sharpness on the image reduced 4 times
+    (the noise is reduced too, so there is no denoising), return {'fname', 'sharpness', 'report'}"""
+    with report.stage('decode', jpg_filepath):
+        img = cv2.imread(jpg_filepath, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    with report.stage('laplacian', jpg_filepath):
+        variance = cv2.Laplacian(img, cv2.CV_64F, ksize=QUICK_LAPLACIAN_KSIZE).var()
     print('.', end='', flush=True)
+    return {'fname': jpg_filepath, 'sharpness': variance, 'report': report.pop_records()}
+
+
+def score_images(func, fnames, args, cache, params, use_cache=True, nproc=2, pool=None):
+    """sharpness of the images estimated by func(fname, *args) in the process pool
+    (the new one of nproc processes if the pool is not given),
+    return {image: sharpness} (the values found in the cache are not estimated again)"""
+    sharpness = {fname: cache.get(fname, params) if use_cache else None for fname in fnames}
+    todo = [fname for fname in fnames if sharpness[fname] is None]
+    if len(todo) < len(fnames):
+        print(f"({len(fnames) - len(todo)} cached)", end='', flush=True)
+
+    if len(todo) > 0:
+        own_pool = pool is None
+        if own_pool:
+            # forked workers must not return the records of the parent again
+            pool = mp.Pool(processes=nproc, initializer=report.pop_records)
+        for result in pool.starmap(func, [(fname,) + args for fname in todo]):
+            report.extend(result['report'])
+            sharpness[result['fname']] = result['sharpness']
+            cache.put(result['fname'], params, result['sharpness'])
+        if own_pool:
+            pool.close()
+            pool.join()
+        cache.save()
+    return sharpness
+
+
+class RunningStats:
+    """Statistics of sharpness values updated as the values come:
+    mean and variance by Welford's online algorithm, sorted list of the values for the median"""
+
+    def __init__(self, values=()):
+        self.values = []
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        bisect.insort(self.values, value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def median(self, start=0):
+        """median of the sorted values starting from start"""
+        n = len(self.values) - start
+        mid = start + n // 2
+        return self.values[mid] if n % 2 == 1 else (self.values[mid - 1] + self.values[mid]) / 2
+
+    def trimmed_stats(self, tolerance=0.01):
+        """median, mean and standard deviation of the values
+        excluding outliers: the least values are excluded one by one until the mean and median
+        differ less than tolerance (every step removes the value from mean and variance in O(1))"""
+        count, mean, m2 = self.count, self.mean, self.m2
+        for start in range(len(self.values)):
+            median = self.median(start)
+            if count == 1 or mean == 0 or abs((median - mean) / mean) < tolerance:
+                break
+            value = self.values[start]
+            count -= 1
+            delta = value - mean
+            mean -= delta / count
+            m2 -= delta * (value - mean)
+        return median, mean, math.sqrt(max(m2, 0.0) / count)
+
+
+def sharpness_stats(values, verbose=True):
+    """median, mean and standard deviation of sharpness distribution
+    try to exclude outliers by popping the least sharp values from list"""
+    median, mean, st_dev = RunningStats(values).trimmed_stats()
+    if verbose:
+        print(f"mean:  {mean}\nmedian:{median}\n{abs((median - mean) / mean)}\n\n")
+    return median, mean, st_dev
+
+
+def flag_blurred(fname):
+    """add extension to the blurred image"""
+    print(' ', fname, "is blurred")
+    os.system(f"mv {fname} {fname}.not_sharp_enough")
+
+
+def watch_folder(cache, use_cache=True, nproc=2, idle_timeout=WATCH_IDLE_TIMEOUT):
+    """check the jpg images in the working directory as they appear there and flag the blurred ones,
+    return when no new image appears for idle_timeout seconds"""
+    print(f"Watching the directory for new images (Ctrl+C to stop)..", end='', flush=True)
+    stats = RunningStats()
+    sharp = {}      # sharpness of the images which have not been flagged
+    stamps = {}     # size and mtime of the new images seen by the previous check
+    checked = set()
+    params = None
+    last_new = time.time()
+    # the same workers check all the images
+    pool = mp.Pool(processes=nproc, initializer=report.pop_records)
+    try:
+        while time.time() - last_new < idle_timeout:
+            # the image is ready when its size and mtime are the same as at the previous check
+            ready = []
+            for fname in sorted(glob.glob('*.jpg')):
+                if fname in checked:
+                    continue
+                stamp = file_stamp(fname)
+                if stamps.get(fname) == stamp:
+                    ready.append(fname)
+                else:
+                    stamps[fname] = stamp
+                    last_new = time.time()
+            if len(ready) == 0:
+                time.sleep(WATCH_INTERVAL)
+                continue
+
+            stack_metadata(ready)
+            if params is None:
+                # noise is estimated from the first image as it is done for the list of images
+                sigma = sigma_estimate(ready[0])
+                params = metric_params(sigma)
+            sharpness = score_images(get_sharpness_metric, ready, (params['sigma'],), cache, params, use_cache, nproc,
+                                     pool)
+            checked.update(ready)
+            for fname in ready:
+                stats.add(sharpness[fname])
+                sharp[fname] = sharpness[fname]
+
+            # the threshold changes with every new image, so all the images are compared to it again
+            if stats.count >= WATCH_MIN_IMAGES:
+                median, mean, st_dev = stats.trimmed_stats()
+                for fname in [x for x in sharp if sharp[x] < mean - 3 * st_dev]:
+                    flag_blurred(fname)
+                    del sharp[fname]
+            last_new = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+        pool.join()
+    print(f"done\n{stats.count} images checked, {stats.count - len(sharp)} blurred", flush=True)
+
+
+def quick_screening(quick):
+    """images which must be checked at full resolution: the ones which quick sharpness
+    is close to the rejection threshold and the calibration ones spread over the range of quick values"""
+    q_median, q_mean, q_st_dev = sharpness_stats(quick.values(), verbose=False)
+    threshold = q_mean - 3 * q_st_dev
+    uncertain = [fname for fname in quick if abs(quick[fname] - threshold) <= QUICK_MARGIN * q_st_dev]
+    ranked = sorted((fname for fname in quick if fname not in uncertain), key=quick.get)
+    n = min(QUICK_CALIBRATION, len(ranked))
+    calibration = [ranked[round(i * (len(ranked) - 1) / max(n - 1, 1))] for i in range(n)]
+    return list(dict.fromkeys(uncertain + calibration))
+
+
+def estimate_from_quick(quick, sharpness):
+    """full sharpness of the images which have been checked by quick metric only,
+    estimated by linear regression of the full values against the quick ones"""
+    checked = list(sharpness)
+    x = [quick[fname] for fname in checked]
+    y = [sharpness[fname] for fname in checked]
+    if len(checked) > 1 and len(set(x)) > 1:
+        slope, intercept = stat.linear_regression(x, y)
+    elif stat.mean(x) != 0:
+        slope, intercept = stat.mean(y) / stat.mean(x), 0.0
+    else:
+        # quick metric of all the checked images is 0 (black or masked images), it tells nothing
+        slope, intercept = 0.0, stat.mean(y)
+    estimated = dict(sharpness)
+    for fname in quick:
+        if fname not in estimated:
+            estimated[fname] = slope * quick[fname] + intercept
+    return estimated
 
 
 def make_and_save_distribution_plot(in_data, in_median, in_mean, in_stdev):
@@ -108,14 +385,13 @@ if __name__ == "__main__":
 
     nproc = 2
 
-    # remove auxiliary data file if exists
-    fname_aux = "0_sharp_check.csv"
-    if os.path.exists(fname_aux):
-        os.remove(fname_aux)
-
     # process the command line arguments
     index_images = False
     save_distribution_plot = False
+    save_report = False
+    use_cache = True
+    fast = False
+    watch = None
     fnames = []
     for arg in sys.argv[1:]:
         if arg[0] == '-':
@@ -127,7 +403,15 @@ if __name__ == "__main__":
                 # remove less the least sharp images
                 # so only the sharpest remain
                 save_distribution_plot = True
-            else:
+            elif arg[1:] == "report":
+                save_report = True
+            elif arg[1:] == "no-cache":
+                use_cache = False
+            elif arg[1:] == "fast":
+                fast = True
+            elif arg[1:] == "watch" or arg[1:].startswith("watch="):
+                watch = float(arg[7:]) if arg[1:].startswith("watch=") else WATCH_IDLE_TIMEOUT
+            elif arg[1:] != "index" and arg[1:] != "i":
                 print(f"\n****Error: unknown option: {arg}!\n")
                 print_usage()
         if os.path.exists(arg):
@@ -136,48 +420,46 @@ if __name__ == "__main__":
 
     nfiles = len(fnames)
 
+    if watch is not None:
+        if index_images or save_distribution_plot or fast or nfiles > 0:
+            print("\n****Error: -watch can't be used with -index, -plot-distribution, -fast or images list!\n")
+            print_usage()
+        watch_folder(SharpnessCache(), use_cache, nproc, watch)
+        if save_report:
+            report.save('stack_sharp_check')
+        sys.exit(0)
+
     if nfiles == 0:
         print("\n****Error: no image is given as input!\n")
         print_usage()
 
     # img = cv2.imread(fnames[0])
     print(f"Checking {nfiles} images for sharpness..", end='', flush=True)
+    # read tags of all images at once
+    stack_metadata(fnames)
     first_image_sigma = sigma_estimate(fnames[0])
 
-    pool = mp.Pool(processes=nproc)
-    # pool.map(get_sharpness_metric, iter(fnames))
-    pool.starmap(get_sharpness_metric, zip(fnames, repeat(first_image_sigma)))
-    pool.close()
-    pool.join()
+    # only the images which are not in the cache are checked
+    cache = SharpnessCache()
+    params = metric_params(first_image_sigma)
+    full_fnames = fnames
+    if fast:
+        quick = score_images(get_quick_metric, fnames, (), SharpnessCache(QUICK_CACHE_FNAME), quick_metric_params(),
+                             use_cache, nproc)
+        full_fnames = quick_screening(quick)
+        print(f"({len(full_fnames)} of {nfiles} images are checked at full resolution)", end='', flush=True)
+    sharpness = score_images(get_sharpness_metric, full_fnames, (first_image_sigma,), cache, params, use_cache, nproc)
+    if fast:
+        sharpness = estimate_from_quick(quick, sharpness)
     print('done', flush=True)
 
-    # read results from data file
-    res = []
-    with open(fname_aux, "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            if len(line) > 0:
-                res.append((line.strip().split(';')[0], float(line.strip().split(';')[1])))
+    res = [(fname, sharpness[fname]) for fname in fnames]
 
     # sort results
     res_s = sorted(res, key=lambda kv: kv[1])
 
     # estimate statistical parameters of sharpness distribution
-    # try to exclude outliers by popping the least shap values from list
-    n_imgs_removed_from_stat_calc = 0
-    while True:
-        sh_list = [x[1] for x in res_s[n_imgs_removed_from_stat_calc:]]
-        median = stat.median(sh_list)
-        mean = stat.mean(sh_list)
-        st_dev = stat.pstdev(sh_list)
-        print(f"mean:  {mean}\nmedian:{median}\n{abs((median - mean) / mean)}\n\n")
-        # escape cycle when mean - median difference is less than 1%
-        if abs((median - mean) / mean) < 0.01:
-            break
-        else:
-            # if mean - median difference is more than 5%:
-            # decrease number of images in the list
-            n_imgs_removed_from_stat_calc += 1
+    median, mean, st_dev = sharpness_stats([x[1] for x in res_s])
 
     if save_distribution_plot:
         make_and_save_distribution_plot([x[1] for x in res], median, mean, st_dev)
@@ -189,10 +471,12 @@ if __name__ == "__main__":
         if index_images:
             index_str = "{:06.0F}".format(round(100 * val[1]))
             os.system(f"mv {val[0]} {index_str + '_' + val[0]}")
+            cache.rename(val[0], index_str + '_' + val[0])
         # add extension to the least sharp images
         if val[1] < mean - 3 * st_dev:
-            print(' ', val[0], "is blurred")
-            os.system(f"mv {val[0]} {val[0]}.not_sharp_enough")
+            flag_blurred(val[0])
+
+    cache.save()
 
-    # cleanup
-    os.remove(fname_aux)
+    if save_report:
+        report.save('stack_sharp_check')
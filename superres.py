@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+#
+# Version: 2026.10.18
+# Author: Serhiy Kobyakov
+
+
+import glob
+import os
+import sys
+import threading
+import cv2
+import numpy as np
+import frame_file
+from feature_store import FeatureStore
+from image_metadata import stack_metadata
+from job_scheduler import TaskGraph, default_mem_budget, parse_size, GB
+from run_report import report
+from stack_align import FEATURES_FNAME, AKAZE_BYTES_PER_PIXEL, WARP_THREADS, WARP_TILE_SIZE, \
+    WARP_TILE_BYTES_PER_PIXEL, WARP_TCA_BYTES_PER_PIXEL, train_features, use_train_features, query_homography, \
+    promote_to_16bit, warp_frame, parse_window
+from stack_avg import SharedAccumulator, averaged_image_fname, finish_averaged_image
+from stack_sharp_check import SharpnessCache, metric_params, sigma_estimate, laplacian_sharpness, \
+    sharpness_stats
+from tca_corr import stack_tca, tca_required, TCA_SAMPLE_SIZE
+
+# decoded frames waiting for the next stage are held in memory while they fit this part of the memory budget
+# (the rest is for the running tasks), the others are spilled into frame files in FRAMES_DIR
+FRAME_CACHE_FRACTION = 0.5
+FRAMES_DIR = 'superres_frames'
+
+# memory used per pixel of the jpg: decoded image, sharpness estimation (gray, denoised
+# and blurred images, float64 laplacian), 16-bit BGRA frame (without upscale only, the upscaled
+# frames are promoted and corrected for TCA tile by tile, see stack_align.warp_frame())
+DECODE_BYTES_PER_PIXEL = 3
+SHARPNESS_BYTES_PER_PIXEL = 3 + 8
+PROMOTE_BYTES_PER_PIXEL = 8
+# per-pixel sum of 4 channels and weight of the upscaled image
+ACC_BYTES_PER_PIXEL = 4 * 8 + 8
+
+
+def print_usage():
+    usage_str = """The script makes the superresolution image of the stack of jpgs at once:
+checks the images for sharpness, upscales them, corrects them for TCA, aligns them to
+the first sharp image and averages them into <first jpg name>_averaged.tif
+(the result is moved to the parent directory as stack_avg.py does).
+
+Every image is decoded once and goes through all the stages in memory, the stages of
+different images run in parallel threads as long as they fit the memory budget.
+No intermediate images are written unless the decoded images don't fit the budget.
+
+Usage: superres.py [options] [images list]
+
+Example: superres.py -tca *.jpg
+
+Options:
+    -mem=<size>:          memory budget, e.g. 24G or 512M (gigabytes if no unit given);
+                          default is 80% of the available memory
+    -upscale=<n>:         upscale the images n times (default 2)
+    -no-sharp-check:      use all the images, the blurred ones are not skipped
+                          (see stack_sharp_check.py)
+    -tca[=<n>]:           correct transverse chromatic aberration, TCA is estimated by tca_correct
+                          on n images (default {TCA_SAMPLE_SIZE}) or taken from the cache, see tca_corr.py -sample
+    -detect-scale=<n>:    detect and match keypoints on images reduced n times, see stack_align.py
+    -ecc:                 refine homography using ECC, see stack_align.py
+    -window=<pixels>:     match keypoints within the window only, see stack_align.py
+    -debug-images:        save the images with keypoints and matches, see stack_align.py
+    -report:              save wall time, CPU time and peak memory of every processing stage
+                          into superres_report.json and superres_report.csv
+"""
+    print(usage_str.format(TCA_SAMPLE_SIZE=TCA_SAMPLE_SIZE))
+    sys.exit(1)
+
+
+class FrameCache:
+    """Decoded images passed from one stage of the pipeline to another
+
+    The images are held in memory while they fit the memory budget, the others are spilled
+    into frame files in FRAMES_DIR and memory-mapped (see frame_file.py)."""
+
+    def __init__(self, mem_budget):
+        self.mem_budget = mem_budget
+        self.nbytes = 0
+        self.frames = {}
+        self.spilled = set()
+        self.lock = threading.Lock()
+
+    def load(self, fname):
+        """decode the jpg (EXIF orientation is applied as jpg2largetif.py does) and keep it until drop()"""
+        with report.stage('decode', fname):
+            img = cv2.imread(fname, cv2.IMREAD_COLOR)
+        with self.lock:
+            fits = self.nbytes + img.nbytes <= self.mem_budget
+            if fits:
+                self.nbytes += img.nbytes
+                self.frames[fname] = img
+        if not fits:
+            spill_fname = os.path.join(FRAMES_DIR, fname + frame_file.FRAME_EXT)
+            with report.stage('spill', fname):
+                os.makedirs(FRAMES_DIR, exist_ok=True)
+                frame_file.write_frame(spill_fname, img)
+            with self.lock:
+                self.spilled.add(fname)
+                self.frames[fname] = frame_file.open_frame(spill_fname)
+
+    def get(self, fname):
+        """decoded image (it is decoded now if it hasn't been loaded)"""
+        with self.lock:
+            img = self.frames.get(fname)
+        if img is not None:
+            return img
+        with report.stage('decode', fname):
+            return cv2.imread(fname, cv2.IMREAD_COLOR)
+
+    def drop(self, fname):
+        """the image is not needed any more"""
+        with self.lock:
+            img = self.frames.pop(fname, None)
+            if img is None:
+                return
+            if fname not in self.spilled:
+                self.nbytes -= img.nbytes
+                return
+            self.spilled.discard(fname)
+        del img
+        os.remove(os.path.join(FRAMES_DIR, fname + frame_file.FRAME_EXT))
+        if len(os.listdir(FRAMES_DIR)) == 0:
+            os.rmdir(FRAMES_DIR)
+
+
+class SuperRes:
+    """The whole project as a single pipeline: sharpness check (stack_sharp_check.py),
+    upscale (jpg2largetif.py), TCA correction (tca_corr.py), alignment (stack_align.py)
+    and averaging (stack_avg.py) of the stack of jpgs
+
+    The pipeline is a graph of tasks (see job_scheduler.TaskGraph):
+        decode + sharpness of every image -> selection of the sharp ones (waits for all of them)
+        TCA estimation (once per camera, lens and focal length)
+        reference: keypoints of the first sharp image, its frame starts the running sum
+        alignment of every sharp image: homography, TCA correction and warp straight onto the upscaled
+                                        grid, added to the running sum tile by tile
+        the averaged image
+    Without the sharpness check there is nothing to wait for, so every image is decoded by its alignment
+    task and the images are never held in memory all at once."""
+
+    def __init__(self, fnames, mem_budget=None, upscale=2, sharp_check=True, tca_sample=None,
+                 detect_scale=1, ecc=False, window=None, debug_images=False):
+        self.fnames = sorted(fnames)
+        self.mem_budget = mem_budget if mem_budget is not None else default_mem_budget()
+        self.upscale = upscale
+        self.sharp_check = sharp_check
+        self.tca_sample = tca_sample
+        self.detect_scale = detect_scale
+        self.ecc = ecc
+        self.window = window
+        self.debug_images = debug_images
+        self.meta = stack_metadata(self.fnames)
+        self.width, self.height = self.meta.image_size(self.fnames[0])
+        self.store = FeatureStore(FEATURES_FNAME)
+        self.acc = None
+        self.sharp_cache = None
+        self.tca_lines = {}
+
+        acc_nbytes = self.width * self.height * self.upscale ** 2 * ACC_BYTES_PER_PIXEL
+        free = max(0, self.mem_budget - acc_nbytes)
+        self.frames = FrameCache(free * FRAME_CACHE_FRACTION)
+        self.task_budget = free - self.frames.mem_budget
+
+    def pixels(self, fname):
+        width, height = self.meta.image_size(fname)
+        return width * height
+
+    def align_mem(self, fname):
+        """memory estimated for the alignment task of the image"""
+        warp_mem = min(WARP_THREADS, self.upscale ** 2 * self.pixels(fname) / WARP_TILE_SIZE ** 2 + 1) * \
+            WARP_TILE_SIZE ** 2 * (WARP_TILE_BYTES_PER_PIXEL +
+                                   (WARP_TCA_BYTES_PER_PIXEL if self.tca_sample is not None else 0))
+        return self.pixels(fname) * (DECODE_BYTES_PER_PIXEL + AKAZE_BYTES_PER_PIXEL / self.detect_scale ** 2 +
+                                     (PROMOTE_BYTES_PER_PIXEL if self.upscale == 1 else 0)) + warp_mem
+
+    def run(self):
+        """run the pipeline, return the name of the averaged image"""
+        graph = TaskGraph(self.task_budget)
+        sharpness = []
+        if self.sharp_check:
+            sigma = sigma_estimate(self.fnames[0])
+            params = metric_params(sigma)
+            self.sharp_cache = SharpnessCache()
+            for fname in self.fnames:
+                decode = graph.add(('decode', fname), lambda fname=fname: self.frames.load(fname),
+                                   mem=self.pixels(fname) * DECODE_BYTES_PER_PIXEL)
+                sharpness.append(graph.add(('sharpness', fname),
+                                           lambda _, fname=fname: self.sharpness(fname, sigma, params),
+                                           [decode], mem=self.pixels(fname) * SHARPNESS_BYTES_PER_PIXEL))
+        select = graph.add('select', lambda *values: self.select(values), sharpness)
+        tca = graph.add('tca', self.estimate_tca, [select])
+        ref = graph.add('reference', self.reference, [select, tca], mem=self.align_mem(self.fnames[0]))
+        aligned = [graph.add(('align', fname), lambda selected, ref_fname, fname=fname:
+                             self.align(fname, selected, ref_fname), [select, ref], mem=self.align_mem(fname))
+                   for fname in self.fnames]
+        result = graph.add('average', lambda *res: self.average([x for x in res if x is not None]), [ref] + aligned)
+        return graph.run()[result]
+
+    def sharpness(self, fname, sigma, params):
+        """sharpness of the decoded image (taken from stack_sharp_check.json if it has been estimated)"""
+        value = self.sharp_cache.get(fname, params)
+        if value is None:
+            value = laplacian_sharpness(self.frames.get(fname), sigma, fname)
+            self.sharp_cache.put(fname, params, value)
+        print('.', end='', flush=True)
+        return fname, value
+
+    def select(self, sharpness):
+        """the images which are sharp enough (all of them without the sharpness check)"""
+        if len(sharpness) == 0:
+            return self.fnames
+        self.sharp_cache.save()
+        median, mean, st_dev = sharpness_stats([value for fname, value in sharpness], verbose=False)
+        selected = []
+        for fname, value in sharpness:
+            if value < mean - 3 * st_dev:
+                print(' ', fname, "is blurred, skipped")
+                self.frames.drop(fname)
+            else:
+                selected.append(fname)
+        return selected
+
+    def estimate_tca(self, selected):
+        """TCA line of every image which needs the correction"""
+        if self.tca_sample is None:
+            return {}
+        return {fname: tca_line for fname, tca_line in stack_tca(selected, self.tca_sample).items()
+                if tca_required(tca_line, *[v * self.upscale for v in self.meta.image_size(fname)])}
+
+    def reference(self, selected, tca_lines):
+        """detect keypoints of the first sharp image and start the running sum with it"""
+        self.tca_lines = tca_lines
+        ref_fname = selected[0]
+        img = self.frames.get(ref_fname)
+        # the size of the image rotated according to EXIF orientation
+        self.height, self.width = img.shape[:2]
+        ref = train_features(ref_fname, self.store, self.detect_scale, img, self.debug_images)
+        use_train_features(ref, self.store, self.ecc, False, self.upscale, 'bf', self.window,
+                           debug_images=self.debug_images)
+        self.acc = SharedAccumulator((self.height * self.upscale, self.width * self.upscale, 4))
+        with report.stage('accumulate', ref_fname):
+            warp_frame(self.frame16(img), np.eye(3), (self.width, self.height), self.upscale,
+                       acc=self.acc, tca_line=self.tca_lines.get(ref_fname))
+        self.frames.drop(ref_fname)
+        print('.', end='', flush=True)
+        return ref_fname
+
+    def frame16(self, img):
+        """the image which is warped: 8-bit BGR jpg is promoted to 16-bit BGRA tile by tile by warp_frame()
+        (the whole image is promoted without upscale); TCA is corrected by the same remap
+        as the image is warped and upscaled, so every channel is resampled once"""
+        if self.upscale != 1:
+            return img
+        return promote_to_16bit(img)
+
+    def align(self, fname, selected, ref_fname):
+        """align the image to the reference one and add it to the running sum"""
+        if fname not in selected or fname == ref_fname:
+            return None
+        img = self.frames.get(fname)
+        found = query_homography(fname, img)
+        if found['features'] is not None:
+            self.store.put(fname, found['features']['params'], found['features']['keypoints'],
+                           found['features']['descriptors'])
+        img = self.frame16(img)
+        with report.stage('warp', fname):
+            warp_frame(img, found['homography'], (self.width, self.height), self.upscale, acc=self.acc,
+                       tca_line=self.tca_lines.get(fname))
+        del img
+        self.frames.drop(fname)
+        print('.', end='', flush=True)
+        return fname
+
+    def average(self, aligned):
+        """save the averaged image of the reference one and all the aligned ones"""
+        self.store.save()
+        output_fname = averaged_image_fname()
+        with report.stage('average', output_fname):
+            im_avg = self.acc.result(np.uint16, len(aligned))
+        self.acc.close(unlink=True)
+        with report.stage('encode', output_fname):
+            cv2.imwrite(output_fname, im_avg)
+        del im_avg
+        # restore metadata from the first jpg
+        finish_averaged_image(output_fname)
+        return output_fname
+
+
+if __name__ == "__main__":
+    mem_budget = default_mem_budget()
+    upscale = 2
+    sharp_check = True
+    tca_sample = None
+    detect_scale = 1
+    ecc = False
+    window = None
+    debug_images = False
+    save_report = False
+
+    fnames = []
+    for arg in sys.argv[1:]:
+        if arg == "--help":
+            print_usage()
+        elif arg.startswith("-mem="):
+            mem_budget = parse_size(arg[5:])
+        elif arg.startswith("-upscale="):
+            upscale = int(arg[9:])
+        elif arg == "-no-sharp-check":
+            sharp_check = False
+        elif arg == "-tca":
+            tca_sample = TCA_SAMPLE_SIZE
+        elif arg.startswith("-tca="):
+            tca_sample = int(arg[5:])
+        elif arg.startswith("-detect-scale="):
+            detect_scale = int(arg[14:])
+        elif arg == "-ecc":
+            ecc = True
+        elif arg.startswith("-window="):
+            window = parse_window(arg[8:])
+            if window is None:
+                print(f"\n****Error: the window must be positive number of pixels: {arg}!\n")
+                print_usage()
+        elif arg == "-debug-images":
+            debug_images = True
+        elif arg == "-report":
+            save_report = True
+        elif os.path.isfile(arg):
+            # append image file to images list
+            fnames.append(arg)
+        else:
+            print(f"\n****Error: unknown option: {arg}!\n")
+            print_usage()
+
+    if len(fnames) == 0:
+        fnames = glob.glob('*.jpg')
+    # debug images of stack_align.py
+    fnames = [x for x in fnames if not x.endswith(("_keypoints.jpg", "_matches.jpg"))]
+    if len(fnames) < 2:
+        print("\n****Error: at least two images must be given as input!\n")
+        print_usage()
+
+    pipeline = SuperRes(fnames, mem_budget, upscale, sharp_check, tca_sample, detect_scale, ecc, window,
+                        debug_images)
+    print(f"Processing {len(fnames)} images (memory budget {round(pipeline.mem_budget / GB, 1)} Gb)..",
+          end='', flush=True)
+    pipeline.run()
+    print('done', flush=True)
+
+    if save_report:
+        report.save('superres')
@@ -2,56 +2,276 @@
 # Version: 2023.07.21
 # Author: Serhiy Kobyakov
 
+import json
 import math
 import os
 import subprocess
 import sys
+import cv2
+import numpy as np
+import frame_file
+from image_metadata import stack_metadata, copy_tags
+from run_report import report
+
+# TCA coefficients estimated in -sample mode are kept in this file for every camera, lens and focal length,
+# so they are reused by all the next stacks shot by the same device
+TCA_CACHE_FNAME = os.path.join(os.path.expanduser('~'), '.tca_corr_cache.json')
+
+# number of images TCA is estimated on in -sample mode (evenly spread over the stack)
+TCA_SAMPLE_SIZE = 3
+
+# tca_correct optimisation parameters (-o), the cache entries are valid for the same ones
+TCA_OPTIMIZE = 'v'
+
+# interpolation of the red and blue channels corrected in-process (-native mode)
+TCA_INTERPOLATION = cv2.INTER_CUBIC
+
+# TCA is corrected by bands of this many rows of the output image, the remap grids are made
+# for every band on the fly, so they never take the memory of the whole image
+TCA_BAND_ROWS = 256
+# memory per pixel of the band: 4 float32 remap grids, float32 temporaries of their computation
+# (coordinates, radius, its polynomial and the products) and the remapped 16-bit channel
+TCA_BAND_BYTES_PER_PIXEL = 4 * 4 + 6 * 4 + 2
+
+# maximum allowed channel shift in pixels (visible to the naked eye)
+# above which we need to correct image for TCA
+TCA_MAX_SHIFT = 0.45
+
+
+def estimate_tca(img_fname):
+    """tca_correct estimation of the radial TCA of the image: '-r a:b:c:d -b a:b:c:d' line for fulla"""
+    # return subprocess.check_output('tca_correct -o abcv {0}'.format(img_fname), shell=True).decode('ascii').strip()
+    if frame_file.is_frame_file(img_fname):
+        # tca_correct can't read frame files, TCA is estimated on the tiff copy of the frame
+        tif_fname = img_fname + '.tif'
+        with report.stage('encode', img_fname):
+            cv2.imwrite(tif_fname, frame_file.open_frame(img_fname))
+        try:
+            return estimate_tca(tif_fname)
+        finally:
+            os.remove(tif_fname)
+    with report.stage('estimate', img_fname):
+        return subprocess.check_output('tca_correct -o {0} {1}'.format(TCA_OPTIMIZE, img_fname),
+                                       shell=True).decode('ascii').strip()
+
+
+def parse_tca_line(tca_line):
+    """'-r a:b:c:d -b a:b:c:d' -> {'r': [a, b, c, d], 'b': [a, b, c, d]}"""
+    words = tca_line.split()
+    return {words[i][1:]: [float(x) for x in words[i + 1].split(':')] for i in range(0, len(words), 2)}
+
+
+def format_tca_line(coeffs):
+    return ' '.join('-{0} {1}'.format(ch, ':'.join(repr(float(x)) for x in coeffs[ch])) for ch in ('r', 'b'))
+
+
+def tca_shifts(tca_line, width, height):
+    """red and blue channels shift (pixels) in the corners of the image of given size"""
+    coeffs = parse_tca_line(tca_line)
+    ther = math.sqrt(pow(width / 2, 2) + pow(height / 2, 2))
+    return ther * abs(1 - 1 / coeffs['r'][3]), ther * abs(1 - 1 / coeffs['b'][3])
+
+
+def tca_required(tca_line, width, height):
+    return max(tca_shifts(tca_line, width, height)) > TCA_MAX_SHIFT
+
+
+def tca_source_coords(x, y, height, width, coeffs):
+    """coordinates the channel with radial TCA coefficients (a, b, c, d) is taken from for the pixels
+    at float32 coordinates x, y of the corrected image of given size
+
+    The radius r is normalized to the half of the shorter side of the image (as in fulla),
+    the channel pixel at radius r is taken from radius (a * r^3 + b * r^2 + c * r + d) * r."""
+    a, b, c, d = coeffs
+    cx, cy = (width - 1) / 2, (height - 1) / 2
+    dx, dy = x - cx, y - cy
+    r = np.sqrt(dx * dx + dy * dy) / (min(width, height) / 2)
+    k = ((a * r + b) * r + c) * r + d
+    return cx + dx * k, cy + dy * k
+
+
+def tca_max_shift(tca_line, height, width):
+    """largest shift (pixels) of the red and blue channels over the image of given size"""
+    half = min(width, height) / 2
+    r = np.linspace(0, math.hypot(width, height) / 2 / half, 1024)
+    return max(float(np.max(np.abs(((a * r + b) * r + c) * r + d - 1) * r)) * half
+               for a, b, c, d in parse_tca_line(tca_line).values())
+
+
+def tca_maps(height, width, tca_line, upscale=1, y0=0, y1=None):
+    """remap grids of the rows y0:y1 of the red and blue channels of the image of given size
+    corrected for radial TCA {'r': (map_x, map_y), 'b': (map_x, map_y)}, see tca_source_coords()
+
+    The grids point to the source image reduced upscale times (pixel centers are preserved),
+    so the correction and the upscale are made by single remap."""
+    y1 = height if y1 is None else y1
+    y, x = np.ogrid[y0:y1, 0:width]
+    x, y = x.astype(np.float32), y.astype(np.float32)
+    maps = {}
+    for ch, coeffs in parse_tca_line(tca_line).items():
+        map_x, map_y = tca_source_coords(x, y, height, width, coeffs)
+        maps[ch] = ((map_x - (upscale - 1) / 2) / upscale, (map_y - (upscale - 1) / 2) / upscale)
+    return maps
+
+
+def tca_memory(width, channel_nbytes):
+    """memory used by correct_tca() of the image of given width (after upscale),
+    channel_nbytes - size of one channel of the source image"""
+    return TCA_BAND_ROWS * width * TCA_BAND_BYTES_PER_PIXEL + 2 * channel_nbytes
+
+
+def correct_tca(img, tca_line, upscale=1, out=None):
+    """correct BGR(A) image for radial TCA ('-r a:b:c:d -b a:b:c:d' line of fulla) by remapping
+    its red and blue channels
+
+    out is img upscaled (upscale) times, its red and blue channels are replaced by the channels of img
+    corrected and upscaled at once; if out is None the corrected copy of img is made.
+    The channels are remapped by bands of TCA_BAND_ROWS rows (see tca_memory()). Return out."""
+    height, width = img.shape[0] * upscale, img.shape[1] * upscale
+    if out is None:
+        out = np.array(img)
+    if img.ndim < 3 or img.shape[2] < 3:
+        # grayscale image has no color channels to shift
+        return out
+    channels = {'r': np.ascontiguousarray(img[..., 2]), 'b': np.ascontiguousarray(img[..., 0])}
+    for y0 in range(0, height, TCA_BAND_ROWS):
+        y1 = min(y0 + TCA_BAND_ROWS, height)
+        maps = tca_maps(height, width, tca_line, upscale, y0, y1)
+        for ch, idx in (('r', 2), ('b', 0)):
+            out[y0:y1, :, idx] = cv2.remap(channels[ch], *maps[ch], TCA_INTERPOLATION,
+                                           borderMode=cv2.BORDER_REPLICATE)
+        del maps
+    return out
+
+
+def lens_key(img_fname):
+    """camera, lens and focal length of the image - the images with the same key have the same TCA
+    (None if the camera or the focal length is unknown)"""
+    meta = stack_metadata()
+    values = [meta.get(img_fname, tag) for tag in ('Make', 'Model', 'LensModel', 'FocalLength')]
+    # lens model is not recorded by many cameras with fixed lens
+    if None in (values[0], values[1], values[3]):
+        return None
+    return '|'.join('' if x is None else str(x) for x in values)
+
+
+class TCACache:
+    """TCA coefficients of every camera, lens and focal length estimated by the previous runs
+
+    {lens key: {'optimize', 'r', 'b', 'images'}}, the entry is valid for the same optimisation parameters,
+    images - the names of the images the coefficients have been estimated on"""
+
+    def __init__(self, fname=TCA_CACHE_FNAME):
+        self.fname = fname
+        self.cache = {}
+        if os.path.isfile(fname):
+            try:
+                with open(fname, 'r') as f:
+                    self.cache = json.load(f)
+            except (ValueError, OSError):
+                self.cache = {}
+
+    def get(self, key):
+        """'-r ... -b ...' line of the lens key (None if it hasn't been estimated yet)"""
+        entry = self.cache.get(key)
+        if entry is None or entry['optimize'] != TCA_OPTIMIZE:
+            return None
+        return format_tca_line(entry)
+
+    def put(self, key, tca_line, images):
+        self.cache[key] = dict(parse_tca_line(tca_line), optimize=TCA_OPTIMIZE, images=images)
+
+    def save(self):
+        # the cache is shared by all the stacks, so it is replaced only by the completely written one
+        tmp_fname = f"{self.fname}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_fname, 'w') as f:
+                json.dump(self.cache, f, indent=1)
+            os.replace(tmp_fname, self.fname)
+        except OSError:
+            pass
+
+
+def sample_images(fnames, n):
+    """n images evenly spread over the list"""
+    if len(fnames) <= n:
+        return list(fnames)
+    return [fnames[int(i)] for i in np.linspace(0, len(fnames) - 1, n).round()]
+
+
+def sampled_tca(fnames, n=TCA_SAMPLE_SIZE):
+    """TCA of the images estimated on n of them: per-coefficient median of the estimations"""
+    estimations = [parse_tca_line(estimate_tca(fname)) for fname in sample_images(fnames, n)]
+    return format_tca_line({ch: np.median([x[ch] for x in estimations], axis=0) for ch in ('r', 'b')})
+
+
+def stack_tca(fnames, n=TCA_SAMPLE_SIZE, use_cache=True):
+    """TCA line for every image: the images are grouped by the camera, lens and focal length,
+    TCA of every group is taken from the cache or estimated on n images of the group (and cached);
+    the images of unknown device are one group which TCA is estimated but never cached"""
+    cache = TCACache()
+    groups = {}
+    for fname in fnames:
+        groups.setdefault(lens_key(fname), []).append(fname)
+    tca_lines = {}
+    for key, group in groups.items():
+        if key is None:
+            # the coefficients of unknown device must not be used for the other stacks
+            print(f"\nEstimating TCA of the images of unknown device on {min(n, len(group))} of {len(group)} images")
+            tca_line = sampled_tca(group, n)
+            tca_lines.update((fname, tca_line) for fname in group)
+            continue
+        tca_line = cache.get(key) if use_cache else None
+        if tca_line is None:
+            print(f"\nEstimating TCA of {key} on {min(n, len(group))} of {len(group)} images")
+            tca_line = sampled_tca(group, n)
+            cache.put(key, tca_line, [os.path.abspath(x) for x in sample_images(group, n)])
+            cache.save()
+        else:
+            print(f"\nTCA of {key} is taken from {cache.fname}")
+        tca_lines.update((fname, tca_line) for fname in group)
+    return tca_lines
 
 
 class TCA_Corr:
     """Perform transverse chromatic aberration (TCA) correction on given image"""
 
-    # maximum allowed channel shift in pixels (visible to the naked eye)
-    # above which we need to correct image for TCA
-    TCA_MAX_SHIFT = 0.45
-
     IMG_FNAME = ''
     IMGW = ''
     IMGH = ''
     THER = ''
     INPLACE = ''
     TCA_LINE = ''
+    NATIVE = False
 
-    def __init__(self, img_fname, inplace):
+    def __init__(self, img_fname, inplace, tca_line=None, native=False):
+        """tca_line - TCA estimated beforehand (see stack_tca()), it is estimated on the image if not given
+        native   - correct the image in-process (see correct_tca()) instead of fulla"""
         self.IMG_FNAME = img_fname
         self.INPLACE = inplace
+        self.NATIVE = native
         self.IMGW, self.IMGH = self.get_image_size()
         print(f"\nImage: {self.IMG_FNAME}, {self.IMGW}x{self.IMGH}")
         self.THER = math.sqrt(pow(self.IMGW / 2, 2) + pow(self.IMGH / 2, 2))
         # print(f"theR: {self.THER}")
-        # self.TCA_LINE = subprocess.check_output('tca_correct -o abcv {0}'.format(self.IMG_FNAME), shell=True).decode('ascii').strip()
-        self.TCA_LINE = subprocess.check_output('tca_correct -o v {0}'.format(self.IMG_FNAME), shell=True).decode(
-            'ascii').strip()
+        self.TCA_LINE = tca_line if tca_line is not None else estimate_tca(self.IMG_FNAME)
         # print(self.TCA_LINE)
 
         if self.tca_correction_required():
-            self.do_correct_tca()
+            with report.stage('correct', self.IMG_FNAME):
+                self.do_correct_tca()
 
     def get_image_size(self):
-        sizeline = subprocess.check_output('exiftool -ImageSize -s -s -s {0}'.format(self.IMG_FNAME), shell=True).decode(
-                'ascii').strip()
-        return int(sizeline.split("x")[0]), int(sizeline.split("x")[1])
+        return stack_metadata().image_size(self.IMG_FNAME)
 
     def tca_correction_required(self):
         """check if CA correction required"""
-        tca_str = self.TCA_LINE.replace(' -b ', ':')
-        rr = abs(1 - 1 / float(tca_str.split(':')[3]))
-        rb = abs(1 - 1 / float(tca_str.split(':')[-1]))
+        shift_r, shift_b = tca_shifts(self.TCA_LINE, self.IMGW, self.IMGH)
 
-        print(f"Red channel shift:  {round(self.THER * rr, 2)} px")
-        print(f"Blue channel shift: {round(self.THER * rb, 2)} px")
+        print(f"Red channel shift:  {round(shift_r, 2)} px")
+        print(f"Blue channel shift: {round(shift_b, 2)} px")
 
-        if (self.THER * rr > self.TCA_MAX_SHIFT) or (self.THER * rb > self.TCA_MAX_SHIFT):
+        if (shift_r > TCA_MAX_SHIFT) or (shift_b > TCA_MAX_SHIFT):
             print("the image shows visible TCA and it will be corrected")
             return True
         else:
@@ -64,7 +284,9 @@ class TCA_Corr:
         fext_with_dot = fext_with_dot.lower()
         tca_corr_fname = fname + "_tca_corr"
 
-        if fext_with_dot == ".jpg":
+        if self.NATIVE:
+            self.do_correct_tca_native(tca_corr_fname + fext_with_dot)
+        elif fext_with_dot == ".jpg":
             os.system('fulla ' + self.TCA_LINE + ' -o ' + tca_corr_fname + fext_with_dot + ' --compression=100 ' + self.IMG_FNAME + ' > /dev/null 2>&1')
         elif fext_with_dot == ".tif" or fext_with_dot == ".tiff":
             os.system('fulla ' + self.TCA_LINE + ' -o ' + tca_corr_fname + fext_with_dot + ' ' + self.IMG_FNAME + ' > /dev/null 2>&1')
@@ -76,6 +298,26 @@ class TCA_Corr:
             if os.path.isfile(tca_corr_fname + fext_with_dot):
                 os.system(f"mv {tca_corr_fname + fext_with_dot} {self.IMG_FNAME}")
 
+    def do_correct_tca_native(self, tca_corr_fname):
+        """correct CA in-process and save the corrected image with the tags of the original one"""
+        if frame_file.is_frame_file(self.IMG_FNAME):
+            header = frame_file.read_frame_header(self.IMG_FNAME)
+            if len(header['shape']) < 3 or header['shape'][2] < 3:
+                print("the grayscale image has no TCA to correct")
+                return
+            img = correct_tca(frame_file.open_frame(self.IMG_FNAME), self.TCA_LINE)
+            frame_file.write_frame(tca_corr_fname, img, header['tags'], header['transform'])
+            return
+        # the pixels are corrected as they are stored, so the orientation tag stays valid
+        img = cv2.imread(self.IMG_FNAME, cv2.IMREAD_UNCHANGED)
+        if img.ndim < 3 or img.shape[2] < 3:
+            print("the grayscale image has no TCA to correct")
+            return
+        img = correct_tca(img, self.TCA_LINE)
+        cv2.imwrite(tca_corr_fname, img, [cv2.IMWRITE_JPEG_QUALITY, 100])
+        del img
+        copy_tags(self.IMG_FNAME, tca_corr_fname, orientation=True)
+
 
 def print_usage():
     usage_str = """The script estimates TCA correction parameters for every given image individually
@@ -88,28 +330,48 @@ Example: tca_corr.py -inplace *.jpg
 
 Options:
     -inplace (-i):  edit images inplace; substitute input image with the corrected one
+    -sample[=<n>]:  estimate TCA on n images (default {TCA_SAMPLE_SIZE}) evenly spread over the images
+                    of the same camera, lens and focal length and correct all of them by the median
+                    coefficients; the coefficients are kept in {TCA_CACHE_FNAME}
+                    and reused for all the next stacks shot by the same device
+    -native:        correct the images in-process (the red and blue channels are remapped)
+                    instead of fulla, frame files (.ppf, see jpg2largetif.py -ppf) are corrected too
+    -no-cache:      estimate TCA in -sample mode even if it has been estimated for the device already
+    -report:        save wall time, CPU time and peak memory of every processing stage
+                    into tca_corr_report.json and tca_corr_report.csv
 """
-    print(usage_str)
+    print(usage_str.format(TCA_SAMPLE_SIZE=TCA_SAMPLE_SIZE, TCA_CACHE_FNAME=TCA_CACHE_FNAME))
     sys.exit(1)
 
 
 if __name__ == "__main__":
 
-    # check if fulla and tca_correct are installed
-    fulla_output = subprocess.check_output('fulla --help | grep fulla', shell=True).decode('ascii').strip()
-    if len(fulla_output) == 0:
-        print("\n Please install hugin in order to use this script!\n")
+    # check if tca_correct is installed (fulla is checked below)
     tca_correct_output = subprocess.check_output('tca_correct --help | grep tca_correct', shell=True).decode('ascii').strip()
     if len(tca_correct_output) == 0:
         print("\n Please install hugin in order to use this script!\n")
 
     inplace = False
+    save_report = False
+    sample_size = None
+    use_cache = True
+    native = False
     fnames = []
     for arg in sys.argv[1:]:
         if arg == "--help":
             print_usage()
         elif arg == "-inplace" or arg == "-i":
             inplace = True
+        elif arg == "-report":
+            save_report = True
+        elif arg == "-sample":
+            sample_size = TCA_SAMPLE_SIZE
+        elif arg.startswith("-sample="):
+            sample_size = int(arg[8:])
+        elif arg == "-native":
+            native = True
+        elif arg == "-no-cache":
+            use_cache = False
         elif os.path.exists(arg):
             # append image file to images list
             fnames.append(arg)
@@ -121,5 +383,22 @@ if __name__ == "__main__":
         print("\n****Error: no images given!")
         print_usage()
 
+    if not native:
+        # check if fulla is installed
+        fulla_output = subprocess.check_output('fulla --help | grep fulla', shell=True).decode('ascii').strip()
+        if len(fulla_output) == 0:
+            print("\n Please install hugin in order to use this script!\n")
+
+    # read tags of all images at once
+    stack_metadata(fnames)
+
+    tca_lines = {}
+    if sample_size is not None:
+        # TCA is estimated once for all the images shot by the same camera with the same lens and zoom
+        tca_lines = stack_tca(fnames, sample_size, use_cache)
+
     for fname in fnames:
-        corr = TCA_Corr(fname, inplace)
+        corr = TCA_Corr(fname, inplace, tca_lines.get(fname), native)
+
+    if save_report:
+        report.save('tca_corr')